@@ -0,0 +1,150 @@
+""" Generate synthetic games for benchmarks and load tests
+
+Networks are in the create_network (POST /network/) JSON format and
+everything is derived from the seed, so the same arguments always give
+the same game.
+
+    PYTHONPATH=gameserver python benchmarks/generate.py --policies 300 --players 10000 > game.json
+"""
+import argparse
+import json
+import math
+import random
+import sys
+import uuid
+
+from flaskext.zodb import Dict
+
+from game import Game
+
+# the game every generated workload is played in
+GAME_START = (2017, 2025, 10, 12000000)
+PLAYERS_SEED = 1 << 32
+
+
+def _id(rnd):
+    return str(uuid.UUID(int=rnd.getrandbits(128), version=4))
+
+
+def _node(rnd, name, leak, activation, max_level):
+    return {'id': _id(rnd),
+            'name': name,
+            'short_name': name,
+            'leakage': leak,
+            'activation_amount': activation,
+            'max_amount': max_level,
+            'connections': []}
+
+
+def generate_network(policies=100, goals=10, depth=4, density=2,
+                     min_weight=1.0, max_weight=50.0, leak=0.1, goal_leak=0.05,
+                     activation=0.0, max_level=0.0, goal_max_level=0.0, seed=1):
+    """ A layered acyclic network
+
+    Policies are spread over depth layers and each one links to density
+    nodes picked from the layers below it, with goals below the last
+    layer, so money always flows down towards the goals.
+    """
+    rnd = random.Random(seed)
+    goal_nodes = [ _node(rnd, 'Goal {}'.format(i), goal_leak, 0.0, goal_max_level)
+                   for i in range(goals) ]
+    policy_nodes = [ _node(rnd, 'Policy {}'.format(i), leak, activation, max_level)
+                     for i in range(policies) ]
+
+    depth = max(1, depth)
+    layers = [ policy_nodes[i::depth] for i in range(depth) ]
+    for i, layer in enumerate(layers):
+        below = [ n for l in layers[i+1:] for n in l ] + goal_nodes
+        for node in layer:
+            for child in rnd.sample(below, min(density, len(below))):
+                node['connections'].append({
+                    'id': _id(rnd),
+                    'from_id': node['id'],
+                    'to_id': child['id'],
+                    'weight': round(rnd.uniform(min_weight, max_weight), 6)})
+
+    return {'goals': goal_nodes, 'policies': policy_nodes}
+
+
+def max_spend_per_tick():
+    game = Game('generate')
+    game.start(*GAME_START)
+    return game.settings.max_spend_per_tick
+
+
+def generate_players(network, players=100, policies_per_player=3, spend=None, seed=1):
+    """ Players funding random policies, spending up to spend per tick each
+
+    Each player also gets the goal and the five policies Game.create_player
+    would otherwise pick with the unseeded utils.random.
+    """
+    # not seed itself, generate_network's stream would give the same ids
+    rnd = random.Random(PLAYERS_SEED + seed)
+    if spend is None:
+        spend = max_spend_per_tick()
+    policy_ids = [ p['id'] for p in network['policies'] ]
+    goal_ids = [ g['id'] for g in network['goals'] ]
+
+    res = []
+    for i in range(players):
+        player_id = _id(rnd)
+        funded = rnd.sample(policy_ids, min(policies_per_player, len(policy_ids)))
+        shares = [ rnd.random() for p in funded ]
+        total = sum(shares) or 1.0
+        res.append({'id': player_id,
+                    'name': 'Player {}'.format(i),
+                    'goal_id': rnd.choice(goal_ids) if goal_ids else None,
+                    'policies': rnd.sample(policy_ids, min(5, len(policy_ids))),
+                    'fundings': [ {'from_id': player_id,
+                                   'to_id': policy_id,
+                                   # rounded down so the sum never exceeds spend
+                                   'amount': math.floor(spend * share / total * 1e6) / 1e6}
+                                  for policy_id, share in zip(funded, shares) ]})
+    return res
+
+
+def build_game(network, players, name='synthetic'):
+    """ A started, in memory Game holding a generated workload """
+    game = Game(name)
+    game.start(*GAME_START)
+    game.create_network(network)
+    for p in players:
+        player = game.create_player(p['name'], id=p['id'], goal_id=p['goal_id'],
+                                    policies=Dict.fromkeys(p['policies'], 0))
+        game.set_policy_funding_for_player(
+            player, [ (f['to_id'], f['amount']) for f in p['fundings'] ])
+    return game
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--policies', type=int, default=100)
+    parser.add_argument('--goals', type=int, default=10)
+    parser.add_argument('--depth', type=int, default=4)
+    parser.add_argument('--density', type=int, default=2, help='links out of each policy')
+    parser.add_argument('--min-weight', type=float, default=1.0)
+    parser.add_argument('--max-weight', type=float, default=50.0)
+    parser.add_argument('--leak', type=float, default=0.1)
+    parser.add_argument('--goal-leak', type=float, default=0.05)
+    parser.add_argument('--players', type=int, default=100)
+    parser.add_argument('--policies-per-player', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--network-only', action='store_true',
+                        help='only output the network, ready for POST /network/')
+    args = parser.parse_args()
+
+    network = generate_network(args.policies, args.goals, args.depth, args.density,
+                               args.min_weight, args.max_weight, args.leak,
+                               args.goal_leak, seed=args.seed)
+    if args.network_only:
+        data = network
+    else:
+        players = generate_players(network, args.players, args.policies_per_player,
+                                   seed=args.seed)
+        data = {'network': network, 'players': players}
+    json.dump(data, sys.stdout, indent=2)
+
+
+if __name__ == '__main__':
+    main()
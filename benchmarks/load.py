@@ -0,0 +1,266 @@
+""" Load test a running game server with many concurrent players
+
+Creates tables and players through the API, has every player set their
+fundings, join a table and claim their budget, then for --duration
+seconds keeps --concurrency clients polling nodes and tables, changing
+fundings and claiming budgets while the game is ticked every
+--tick-interval seconds. Throughput and latency percentiles are
+reported per endpoint and phase.
+
+    PYTHONPATH=.:gameserver python benchmarks/load.py --api-key KEY --players 2000
+"""
+import argparse
+import httplib
+import json
+import random
+import sys
+import threading
+import urlparse
+from Queue import Queue, Empty
+from time import time, sleep
+
+from profiling import percentile
+from generate import generate_network
+
+
+class Stats(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+        self.started = time()
+        self.finished = None
+
+    def record(self, name, latency, ok):
+        with self._lock:
+            self.latencies.setdefault(name, []).append(latency)
+            if not ok:
+                self.errors[name] = self.errors.get(name, 0) + 1
+
+    def stop(self):
+        self.finished = time()
+
+    def summary(self):
+        elapsed = (self.finished or time()) - self.started
+        res = {}
+        with self._lock:
+            for name, latencies in self.latencies.items():
+                values = sorted(latencies)
+                res[name] = dict(count=len(values),
+                                 errors=self.errors.get(name, 0),
+                                 throughput=len(values) / elapsed if elapsed else 0.0,
+                                 p50=percentile(values, 50),
+                                 p95=percentile(values, 95),
+                                 p99=percentile(values, 99),
+                                 max=values[-1])
+        return res
+
+    def report(self, title):
+        print "{} ({:.1f}s)".format(title, (self.finished or time()) - self.started)
+        print "  {:42} {:>7} {:>6} {:>8} {:>8} {:>8} {:>8}".format(
+            'endpoint', 'count', 'errors', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms')
+        for name, s in sorted(self.summary().items()):
+            print "  {:42} {:7d} {:6d} {:8.1f} {:8.1f} {:8.1f} {:8.1f}".format(
+                name, s['count'], s['errors'], s['throughput'],
+                s['p50'] * 1000, s['p95'] * 1000, s['p99'] * 1000)
+
+
+class Client(object):
+    """ A keep-alive connection to the server, one per thread """
+
+    def __init__(self, url, api_key, stats):
+        parts = urlparse.urlparse(url)
+        self.host = parts.netloc
+        self.base = parts.path.rstrip('/')
+        self.api_key = api_key
+        self.stats = stats
+        self.conn = httplib.HTTPConnection(self.host)
+
+    def request(self, method, path, name, data=None, user_key=None):
+        headers = {'Content-Type': 'application/json',
+                   'X-API-KEY': self.api_key}
+        if user_key:
+            headers['X-USER-KEY'] = user_key
+        body = json.dumps(data) if data is not None else None
+
+        t0 = time()
+        try:
+            self.conn.request(method, self.base + path, body, headers)
+            response = self.conn.getresponse()
+            content = response.read()
+            status = response.status
+        except (httplib.HTTPException, IOError):
+            # start again on a fresh connection
+            self.conn.close()
+            self.conn = httplib.HTTPConnection(self.host)
+            self.stats.record('{} {}'.format(method, name), time() - t0, False)
+            return None
+        self.stats.record('{} {}'.format(method, name), time() - t0, status < 400)
+        if status >= 400:
+            return None
+        try:
+            return json.loads(content)
+        except ValueError:
+            return content
+
+
+def run_workers(concurrency, make_client, work):
+    """ Calls work(client, item) for every item put on the returned queue """
+    queue = Queue()
+
+    def worker():
+        client = make_client()
+        while True:
+            item = queue.get()
+            if item is None:
+                return
+            work(client, item)
+
+    threads = [ threading.Thread(target=worker) for i in range(concurrency) ]
+    for t in threads:
+        t.daemon = True
+        t.start()
+
+    def finish():
+        for t in threads:
+            queue.put(None)
+        for t in threads:
+            t.join()
+    return queue, finish
+
+
+def setup_players(args, make_client, tables, max_spend):
+    players = []
+    lock = threading.Lock()
+
+    def create(client, i):
+        rnd = random.Random(args.seed + i)
+        p = client.request('POST', '/players/', '/players/', {'name': 'Load {}'.format(i)})
+        if not p:
+            return
+        policies = [ x['id'] for x in p['policies'] ]
+        shares = [ rnd.random() for x in policies ]
+        total = sum(shares) or 1.0
+        funding = [ {'from_id': p['id'], 'to_id': policy_id,
+                     'amount': int(max_spend * share / total)}
+                    for policy_id, share in zip(policies, shares) ]
+        client.request('PUT', '/players/{}/funding'.format(p['id']),
+                       '/players/{player_id}/funding', funding, user_key=p['token'])
+        if tables:
+            client.request('PUT', '/players/{}/table/{}'.format(p['id'], rnd.choice(tables)),
+                           '/players/{player_id}/table/{table_id}', user_key=p['token'])
+        client.request('PUT', '/players/{}/claim_budget'.format(p['id']),
+                       '/players/{player_id}/claim_budget', user_key=p['token'])
+        with lock:
+            players.append(dict(id=p['id'], token=p['token'], policies=policies))
+
+    queue, finish = run_workers(args.concurrency, make_client, create)
+    for i in range(args.players):
+        queue.put(i)
+    finish()
+    return players
+
+
+def steady_state(args, make_client, players, tables, node_ids, max_spend):
+    deadline = time() + args.duration
+    stopped = threading.Event()
+
+    def ticker():
+        client = make_client()
+        while not stopped.wait(args.tick_interval):
+            client.request('PUT', '/game/tick', '/game/tick')
+
+    def player(n):
+        rnd = random.Random(args.seed * 1000 + n)
+        client = make_client()
+        while time() < deadline:
+            p = rnd.choice(players)
+            action = rnd.random()
+            if action < 0.4:
+                client.request('GET', '/network/{}'.format(rnd.choice(node_ids)), '/network/{id}')
+            elif action < 0.7 and tables:
+                client.request('GET', '/tables/{}'.format(rnd.choice(tables)), '/tables/{id}')
+            elif action < 0.9:
+                amount = int(max_spend / max(1, len(p['policies'])))
+                funding = [ {'from_id': p['id'], 'to_id': policy_id, 'amount': amount}
+                            for policy_id in p['policies'] ]
+                client.request('PUT', '/players/{}/funding'.format(p['id']),
+                               '/players/{player_id}/funding', funding, user_key=p['token'])
+            else:
+                client.request('PUT', '/players/{}/claim_budget'.format(p['id']),
+                               '/players/{player_id}/claim_budget', user_key=p['token'])
+
+    threads = [ threading.Thread(target=player, args=(n,)) for n in range(args.concurrency) ]
+    if args.tick_interval:
+        threads.append(threading.Thread(target=ticker))
+    for t in threads:
+        t.daemon = True
+        t.start()
+    while time() < deadline:
+        sleep(0.1)
+    stopped.set()
+    for t in threads:
+        t.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='http://localhost:8080/v1')
+    parser.add_argument('--api-key', required=True)
+    parser.add_argument('--players', type=int, default=1000)
+    parser.add_argument('--tables', type=int, default=10)
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--duration', type=float, default=60.0,
+                        help='seconds to run the mixed workload for')
+    parser.add_argument('--tick-interval', type=float, default=3.0,
+                        help='seconds between ticks, 0 to not tick')
+    parser.add_argument('--network', type=int, default=0, metavar='POLICIES',
+                        help='replace the network with a generated one of this many policies first')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='write the per phase summaries to this JSON file')
+    args = parser.parse_args()
+
+    setup_stats = Stats()
+    make_setup_client = lambda: Client(args.url, args.api_key, setup_stats)
+    client = make_setup_client()
+
+    if args.network:
+        network = generate_network(policies=args.network, goals=max(1, args.network // 10),
+                                   seed=args.seed)
+        client.request('POST', '/network/', '/network/', network)
+
+    game = client.request('GET', '/game', '/game')
+    network = client.request('GET', '/network/', '/network/')
+    if not game or not network:
+        print >>sys.stderr, "Can't read the game from {}".format(args.url)
+        sys.exit(1)
+    max_spend = game['max_spend_per_tick'] or 0
+    node_ids = [ n['id'] for n in network['policies'] + network['goals'] ]
+
+    tables = []
+    for i in range(args.tables):
+        t = client.request('POST', '/tables/', '/tables/', {'name': 'Load {}'.format(i)})
+        if t:
+            tables.append(t['id'])
+
+    players = setup_players(args, make_setup_client, tables, max_spend)
+    setup_stats.stop()
+    setup_stats.report("setup: {} players, {} tables".format(len(players), len(tables)))
+
+    run_stats = Stats()
+    if players and node_ids:
+        steady_state(args, lambda: Client(args.url, args.api_key, run_stats),
+                     players, tables, node_ids, max_spend)
+    run_stats.stop()
+    run_stats.report("mixed workload: {} clients".format(args.concurrency))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(dict(setup=setup_stats.summary(), run=run_stats.summary()),
+                      f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
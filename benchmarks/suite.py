@@ -0,0 +1,178 @@
+""" Benchmarks for the wallet, tick and serialisation hot paths
+
+Results are written as JSON and can be compared against a saved run,
+any benchmark slower than the baseline by more than the threshold is
+reported and the exit status is 1.
+
+    PYTHONPATH=.:gameserver python benchmarks/suite.py --output baseline.json
+    PYTHONPATH=.:gameserver python benchmarks/suite.py --compare baseline.json
+"""
+import argparse
+import json
+import platform
+import sys
+import uuid
+from datetime import datetime
+from time import time
+
+import transaction
+
+from wallet import Wallet
+from utils import node_to_dict
+from generate import generate_network, generate_players, build_game
+
+WALLET_SIZE = 1000
+DEFAULT_SCALES = '100x50,1000x200,10000x300'
+
+
+def parse_scales(scales):
+    """ '1000x200,...' -> [(players, nodes), ...] """
+    return [ tuple(int(x) for x in s.split('x')) for s in scales.split(',') if s ]
+
+
+def wallet_benchmarks():
+    # 16 byte keys like real player ids, longer ones are cut short by dumps
+    items = [ (uuid.UUID(int=i).bytes, 1000.0 + i) for i in range(WALLET_SIZE) ]
+    source = Wallet(items)
+    other = Wallet(items[::2])
+    data = source.dumps()
+
+    def transfer():
+        source.transfer(Wallet(), 1.0)
+
+    yield 'wallet.transfer', transfer, 1000
+    yield 'wallet.leak', lambda: source.leak(0.0001), 1000
+    yield 'wallet.and', lambda: source & other, 100
+    yield 'wallet.dumps', source.dumps, 100
+    yield 'wallet.loads', lambda: Wallet().loads(data), 100
+
+
+def game_benchmarks(num_players, num_nodes):
+    num_goals = max(1, num_nodes // 10)
+    network = generate_network(policies=num_nodes - num_goals, goals=num_goals)
+    game = build_game(network, generate_players(network, num_players))
+    # spread money around so ticks move real balances
+    game.tick(3)
+    scale = '{}x{}'.format(num_players, num_nodes)
+
+    def rank():
+        for goal in game.get_goals():
+            goal.rank
+
+    def get_network():
+        network = game.get_network()
+        [ node_to_dict(n) for n in network['goals'] ]
+        [ node_to_dict(n) for n in network['policies'] ]
+
+    yield 'game.tick[{}]'.format(scale), game.tick, 1
+    yield 'node.rank[{}]'.format(scale), rank, 1
+    yield 'game.get_network[{}]'.format(scale), get_network, 1
+    for benchmark in table_benchmarks(game, scale):
+        yield benchmark
+
+
+def table_benchmarks(game, scale, table_size=20):
+    from main import app
+    from database import get_db
+    from controllers import generate_table_data
+
+    table = game.create_table('benchmark')
+    for player in list(game.get_players())[:table_size]:
+        game.add_player_to_table(player.id, table.id)
+
+    app.config['ZODB_STORAGE'] = 'memory://'
+
+    # one request context and connection for every run, only the
+    # rendering is timed
+    ctx = app.test_request_context()
+    ctx.push()
+    try:
+        get_db()['game'] = game
+        yield 'generate_table_data[{}]'.format(scale), lambda: generate_table_data(table), 1
+    finally:
+        transaction.abort()
+        ctx.pop()
+
+
+def measure(f, number, repeat):
+    samples = []
+    for i in range(repeat):
+        t0 = time()
+        for j in xrange(number):
+            f()
+        samples.append((time() - t0) / number)
+    samples.sort()
+    return dict(min=samples[0],
+                median=samples[len(samples) // 2],
+                number=number,
+                repeat=repeat)
+
+
+def run(scales, repeat, only=None):
+    results = {}
+
+    def benchmarks():
+        for b in wallet_benchmarks():
+            yield b
+        for num_players, num_nodes in scales:
+            for b in game_benchmarks(num_players, num_nodes):
+                yield b
+
+    for name, f, number in benchmarks():
+        if only and only not in name:
+            continue
+        results[name] = measure(f, number, repeat)
+        print >>sys.stderr, "{:45} {:12.6f}s".format(name, results[name]['median'])
+    return results
+
+
+def compare(results, baseline, threshold):
+    """ Names of the benchmarks more than threshold slower than baseline """
+    regressions = []
+    for name, result in sorted(results.items()):
+        base = baseline.get(name)
+        if base is None:
+            print "{:45} {:>12}".format(name, 'new')
+            continue
+        ratio = result['median'] / base['median'] if base['median'] else 1.0
+        flag = ''
+        if ratio > 1.0 + threshold:
+            flag = 'REGRESSION'
+            regressions.append(name)
+        print "{:45} {:12.6f}s {:12.6f}s {:6.2f}x {}".format(
+            name, base['median'], result['median'], ratio, flag)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scales', default=DEFAULT_SCALES,
+                        help='comma separated PLAYERSxNODES game sizes')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--only', help='only run benchmarks whose name contains this')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='compare against the results in this JSON file')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='slowdown over the baseline reported as a regression')
+    args = parser.parse_args()
+
+    results = run(parse_scales(args.scales), args.repeat, args.only)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(dict(meta=dict(date=datetime.now().isoformat(),
+                                     python=platform.python_version(),
+                                     scales=args.scales,
+                                     repeat=args.repeat),
+                           results=results), f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+""" Time the leak phase and full ticks on a synthetic game
+
+    PYTHONPATH=gameserver python benchmarks/tick.py --players 10000 --nodes 300
+"""
+import argparse
+from time import time
+
+from generate import generate_network, generate_players, build_game
+
+
+def per_node_leak(game):
+    # the leak phase as it was before rates were precomputed
+    for node in game.get_ranked_nodes():
+        node.do_leak()
+
+
+def timed(f, repeat):
+    t0 = time()
+    for i in range(repeat):
+        f()
+    return (time() - t0) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--players', type=int, default=10000)
+    parser.add_argument('--nodes', type=int, default=300)
+    parser.add_argument('--ticks', type=int, default=5)
+    args = parser.parse_args()
+
+    t0 = time()
+    num_goals = max(1, args.nodes // 10)
+    network = generate_network(policies=args.nodes - num_goals, goals=num_goals)
+    game = build_game(network, generate_players(network, args.players))
+    print "built {} players x {} nodes in {:.2f}s".format(args.players, args.nodes, time() - t0)
+
+    # spread some money around the network before measuring
+    for i in range(3):
+        game.tick()
+
+    print "leak, per node:     {:.4f}s".format(timed(lambda: per_node_leak(game), args.ticks))
+    print "leak, batched:      {:.4f}s".format(timed(game.do_leak, args.ticks))
+    print "fund + propagate:   {:.4f}s".format(timed(game.do_propogate_funds, args.ticks))
+    print "full tick:          {:.4f}s".format(timed(game.tick, args.ticks))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,8 @@
 import logging.config
 from decorator import decorator
 from flask import request, abort, g
+import transaction
+from ZODB.POSException import ConflictError
 
 from game import Game
 from utils import node_to_dict, player_to_dict, node_to_dict2, edge_to_dict, edges_to_checksum, player_to_league_dict, message_to_dict, player_to_funding_dict
@@ -11,8 +13,11 @@ import dateutil.parser
 from datetime import datetime
 
 from gameserver.models import Player, Goal, Edge, Policy, Table
-from gameserver.database import get_db
+from gameserver.database import get_db, commit_with_retries
 from gameserver.game import get_game
+from gameserver.snapshot import league_rows
+from gameserver.scheduler import tick_coalescer
+from gameserver.profiling import tick_profiler
 
 log = logging.getLogger(__name__)
 
@@ -46,18 +51,61 @@ def require_api_key(f, *args, **kw):
 
     return f(*args, **kw)
 
+@decorator
+def snapshot_read(f, *args, **kw):
+    """ Let the write-behind store serve the read from the published snapshot """
+    g.snapshot_read = True
+    return f(*args, **kw)
+
+@decorator
+def retry_on_conflict(f, *args, **kw):
+    """ Commit in the view, retrying conflicts with commit_with_retries """
+    try:
+        return commit_with_retries(f, *args, **kw)
+    except ConflictError:
+        return "Conflict with another request, try again", 409
+
+def _tick_and_commit(game, ticks):
+    seq = game.tick(ticks)
+    game.publish_tick()
+    # commit before the result is shared with coalesced callers so they
+    # never report a tick that was then lost to a conflict
+    transaction.commit()
+    return seq
+
 @require_api_key
-def do_tick():
+def do_tick(ticks=1):
     t0 = time()
     game = get_game()
     t1 = time()
-    game.tick()
+    start_seq = game.settings.tick_seq
+
+    def tick():
+        seq = game.settings.tick_seq
+        if seq != start_seq:
+            # retrying after another worker's tick committed, that tick
+            # stands in for this one rather than running both
+            return seq, False
+        return tick_coalescer.run((game.id, ticks), lambda: _tick_and_commit(game, ticks))
+
+    try:
+        seq, ran = commit_with_retries(tick)
+    except ValueError, e:
+        return str(e), 400
+    except ConflictError:
+        return "Conflict with another request, try again", 409
     t2 = time()
     msg = 'entire tick {:.2f}, get_game: {:.2f}'.format(t2-t1, t1-t0)
     log.debug(msg)
 
-    return msg, 200
+    return dict(seq=seq, coalesced=not ran, message=msg), 200
 
+@require_api_key
+def get_tick_profile():
+    return dict(summary=tick_profiler.summary(),
+                ticks=tick_profiler.recent()), 200
+
+@retry_on_conflict
 @require_api_key
 def clear_players():
     game.clear_players()
@@ -72,6 +120,7 @@ def player_fundings():
 
     return fundings, 200
 
+@snapshot_read
 @require_api_key
 def league_table():
     res = _league_table()
@@ -79,24 +128,12 @@ def league_table():
 
 def _league_table():
     game = get_game()
-    res = []
-    top = game.top_players()
-    for t in top:
-        
-        if not t.goal_id:
-            continue 
-
-        goal = game.get_goal(t.goal_id)
-        r = {'id': t.id,
-             'name': t.name,
-             'goal': goal.name,
-             'goal_contribution': "{:.2f}".format(game.goal_funded_by_player(t.id)),
-             'goal_total': "{:.2f}".format(goal.balance),
-             }
-        res.append(r)
-
-    return dict(rows=res)
+    snapshot = game.get_snapshot()
+    if snapshot is not None:
+        return dict(rows=list(snapshot.league))
+    return dict(rows=league_rows(game))
 
+@retry_on_conflict
 @require_api_key
 def create_network(network):
     game = get_game()
@@ -105,18 +142,66 @@ def create_network(network):
 
     return _get_network(), 201
 
+@retry_on_conflict
+@require_api_key
+def add_to_network(network):
+    game = get_game()
+    try:
+        game.add_to_network(network)
+    except ValueError, e:
+        return str(e), 400
+
+    return _get_network(), 201
+
+@require_api_key
+def get_forecast(ticks=10):
+    game = get_game()
+    try:
+        forecast = game.forecast(ticks)
+    except ValueError, e:
+        return str(e), 400
+
+    res = dict(ticks=ticks, generated=asctime())
+    for key, balances in forecast.items():
+        res[key] = [ {'id': id, 'balance': float("{:.2f}".format(balance))}
+                     for id, balance in balances ]
+    return res, 200
+
+@require_api_key
+def get_steady_state(max_ticks=1000):
+    game = get_game()
+    try:
+        state = game.steady_state(max_ticks)
+    except ValueError, e:
+        return str(e), 400
+
+    res = dict(converged=state['converged'], generated=asctime())
+    for key in ('goals', 'policies'):
+        res[key] = [ {'id': id,
+                      'inflow': float("{:.2f}".format(inflow)),
+                      'rate': float("{:.2f}".format(rate))}
+                     for id, inflow, rate in state[key] ]
+    return res, 200
+
+@snapshot_read
 @require_api_key
 def get_network():
     return _get_network(), 200
 
 def _get_network():
     game = get_game()
+    snapshot = game.get_snapshot()
+    if snapshot is not None:
+        return dict(goals=list(snapshot.goals),
+                    policies=list(snapshot.policies),
+                    generated=asctime())
     network =  game.get_network()
     network['goals'] = [ node_to_dict(g) for g in network['goals'] ]
     network['policies'] = [ node_to_dict(p) for p in network['policies'] ]
     network['generated'] = asctime()
     return network
 
+@retry_on_conflict
 @require_api_key
 def update_network(network):
     game = get_game()
@@ -160,6 +245,7 @@ def get_player(player_id):
         return "Player not found", 404
 
 
+@retry_on_conflict
 @require_api_key
 def create_player(player=None):
     """
@@ -194,6 +280,7 @@ def update_player(player_id, player=None):
     db_session.commit()
     return player_to_dict(p), 200
 
+@retry_on_conflict
 @require_api_key
 @require_user_key
 def set_player_table(player_id, table_id):
@@ -213,6 +300,7 @@ def set_player_table(player_id, table_id):
 
     return player_to_dict(game, p), 200
 
+@retry_on_conflict
 @require_api_key
 @require_user_key
 def delete_player_table(player_id, table_id):
@@ -232,6 +320,7 @@ def delete_player_table(player_id, table_id):
 
     return player_to_dict(game, p), 200
 
+@retry_on_conflict
 @require_api_key
 @require_user_key
 def set_funding(player_id, funding = None):
@@ -269,6 +358,7 @@ def get_policy_offer(player_id, policy_id, price=None):
     except ValueError, e:
         return str(e), 400
     
+@retry_on_conflict
 @require_api_key
 @require_user_key
 def buy_policy(player_id, offer):
@@ -279,6 +369,7 @@ def buy_policy(player_id, offer):
     except ValueError, e:
         return str(e), 400
    
+@retry_on_conflict
 @require_api_key
 @require_user_key
 def claim_budget(player_id):
@@ -287,17 +378,19 @@ def claim_budget(player_id):
         player = game.get_player(player_id)
         if player is None:
             return "Player not found", 404
-        player.claim_budget()
+        game.claim_budget(player)
         return "budget claimed", 200
     except ValueError, e:
         return str(e), 400
 
+@retry_on_conflict
 @require_api_key
 def create_table(table = None):
     game = get_game()
     table = game.create_table(table['name'])
     return generate_table_data(table), 201
 
+@retry_on_conflict
 @require_api_key
 def clear_table(id):
     game = get_game()
@@ -319,6 +412,7 @@ def get_table(id):
     data = generate_table_data(table)
     return data, 200
 
+@retry_on_conflict
 @require_api_key
 def delete_table(id):
     game = get_game()
@@ -333,6 +427,12 @@ def generate_table_data(table):
     name = table.name
     players = tuple(table.players)
     network = game.get_network(players)
+    snapshot = game.get_snapshot()
+
+    def node_data(n):
+        if snapshot is not None and n.id in snapshot.nodes:
+            return dict(snapshot.nodes[n.id])
+        return node_to_dict2(n)
 
     nodes = {}
     links = []
@@ -347,13 +447,13 @@ def generate_table_data(table):
         links.extend([edge_to_dict(e) for e in n.lower_edges])
 
     for n in network['policies']:
-        data = node_to_dict2(n)
+        data = node_data(n)
         data['group'] = 9
         nodes[n.id] = data
         links.extend([edge_to_dict(e) for e in n.lower_edges])
 
     for n in network['goals']:
-        data = node_to_dict2(n)
+        data = node_data(n)
         nodes[n.id] = data
 
     links = [ l for l in links 
@@ -395,12 +495,14 @@ def _get_metadata():
             }
 
 # move to game class
+@retry_on_conflict
 @require_api_key
 def stop_game():
     game = get_game()
     year = game.stop()
     return "game stopped at year {}".format(year), 200
 
+@retry_on_conflict
 @require_api_key
 def start_game(params):
     game = get_game()
@@ -408,6 +510,7 @@ def start_game(params):
     game.do_replenish_budget()
     return "game started, year {}".format(year), 200
 
+@retry_on_conflict
 @require_api_key
 def set_messages(messages):
     game = get_game()
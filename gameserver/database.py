@@ -1,13 +1,46 @@
+import logging.config
+import random
+from time import sleep
+
+import transaction
+from ZODB.POSException import ConflictError
 from flaskext.zodb import ZODB
 from flaskext.zodb import BTree
 
-from flask import g
+from flask import g, current_app
+
+from settings import CONFLICT_RETRIES, CONFLICT_BACKOFF
+
+log = logging.getLogger(__name__)
 
 def get_db():
     if '_zodb' not in g:
         g._zodb = ZODB()
     return g._zodb
 
+def commit_with_retries(f, *args, **kw):
+    """ Run f and commit, running it again if another worker's commit conflicts
+
+    Conflicts the models can't resolve themselves (see _p_resolveConflict)
+    are retried CONFLICT_RETRIES times with a randomised, growing backoff,
+    after which the ConflictError is raised.
+    """
+    for attempt in range(CONFLICT_RETRIES + 1):
+        try:
+            res = f(*args, **kw)
+            transaction.commit()
+            return res
+        except ConflictError, e:
+            transaction.abort()
+            # the instance main renders, this module may see another copy
+            metrics = current_app.extensions.get('metrics')
+            if metrics is not None:
+                metrics.count_conflict()
+            log.info("Conflict in {} on attempt {}: {}".format(f.__name__, attempt + 1, e))
+            if attempt == CONFLICT_RETRIES:
+                raise
+            sleep(random.uniform(0, CONFLICT_BACKOFF * 2 ** attempt))
+
 def Xreset_database(db):
     db['players'] = BTree()
     db['policies'] = BTree()
@@ -0,0 +1,170 @@
+import logging.config
+from array import array
+from itertools import izip
+
+log = logging.getLogger(__name__)
+
+
+class PropagationPlan(object):
+    """ Immutable array form of a ranked network
+
+    Nodes are numbered by their position in the ranked node list. The
+    outgoing edges of node i are out_dst[k], out_weight[k] for k in
+    out_ptr[i]:out_ptr[i+1] (CSR layout), and only edges with a positive
+    weight are kept since those are the only ones that carry funds. An
+    edge to a node outside the plan has out_dst -1: its share still
+    leaves the node, as it does in Network.propagate, but lands nowhere.
+    leak[i] is the node's effective leak rate (see Node.get_leak).
+    """
+
+    def __init__(self, ranked_nodes):
+        ids = tuple(n.id for n in ranked_nodes)
+        index = { id: i for i,id in enumerate(ids) }
+
+        out_ptr = array('l', [0])
+        out_dst = array('l')
+        out_weight = array('d')
+        children_weight = array('d')
+        for node in ranked_nodes:
+            total = 0.0
+            for edge in node.lower_edges:
+                weight = edge.weight
+                if weight <= 0:
+                    continue
+                total += weight
+                out_dst.append(index.get(edge.lower_node.id, -1))
+                out_weight.append(weight)
+            out_ptr.append(len(out_dst))
+            children_weight.append(total)
+
+        d = self.__dict__
+        d['ids'] = ids
+        d['index'] = index
+        d['out_ptr'] = out_ptr
+        d['out_dst'] = out_dst
+        d['out_weight'] = out_weight
+        d['children_weight'] = children_weight
+        d['activation'] = array('d', [ n.activation or 0.0 for n in ranked_nodes ])
+        d['max_level'] = array('d', [ n.max_level or 0.0 for n in ranked_nodes ])
+        d['leak'] = array('d', [ n.get_leak() for n in ranked_nodes ])
+
+    def __setattr__(self, name, value):
+        raise AttributeError("PropagationPlan is immutable")
+
+    def __len__(self):
+        return len(self.ids)
+
+    def is_quiescent(self, i, node, quiet_level):
+        """ True if propagating node i with no inflow would change nothing
+
+        quiet_level is the active level a node with no inflow is given.
+        """
+        if node.active_level != quiet_level:
+            return False
+        balance = node.balance
+        if balance > 0:
+            max_level = self.max_level[i]
+            if max_level and balance > max_level:
+                return False
+            if quiet_level >= self.activation[i] and self.children_weight[i]:
+                return False
+        return True
+
+
+class Forecast(object):
+    """ Projects node balances forward without touching the network
+
+    Only the totals decide how much money moves in a tick: leak, player
+    inflow, max_level and edge transfers all act on a node's balance and
+    spread over the players in its wallet proportionally. So a forecast
+    is run on a snapshot of per-node balances and per-policy inflow
+    against the PropagationPlan, never on the nodes themselves.
+    """
+
+    def __init__(self, plan, balances, inflow, total_player_inflow):
+        self.plan = plan
+        self.balances = array('d', balances)
+        self.inflow = array('d', inflow)
+        self.total_player_inflow = total_player_inflow
+
+    @classmethod
+    def snapshot(cls, network):
+        plan = network.plan
+        inflow = array('d', [0.0]) * len(plan)
+        for policy_id, funders in network.funders.items():
+            i = plan.index.get(policy_id)
+            if i is not None:
+                inflow[i] = sum(amount for key, amount in funders.values())
+        balances = [ n.balance for n in network.ranked_nodes ]
+        return cls(plan, balances, inflow, network.total_player_inflow)
+
+    def step(self):
+        """ Runs one tick, returns what each node received in it """
+        plan = self.plan
+        out_ptr = plan.out_ptr
+        out_dst = plan.out_dst
+        out_weight = plan.out_weight
+        leak = plan.leak
+        activation = plan.activation
+        max_level = plan.max_level
+        children_weight = plan.children_weight
+        total_player_inflow = self.total_player_inflow
+        balances = self.balances
+
+        received = array('d', self.inflow)
+        for i in xrange(len(balances)):
+            if leak[i]:
+                balances[i] *= 1.0 - leak[i]
+
+        for i in xrange(len(balances)):
+            balance = balances[i] + received[i]
+            if max_level[i] and balance > max_level[i]:
+                balance = max_level[i]
+
+            if total_player_inflow > 0:
+                # measured before trimming, as Network.propagate does
+                active_level = received[i] / total_player_inflow
+            else:
+                active_level = 1.0
+
+            if active_level >= activation[i] and balance > 0 and children_weight[i]:
+                total_out_factor = min(1.0, balance / children_weight[i])
+                for k in xrange(out_ptr[i], out_ptr[i+1]):
+                    amount = out_weight[k] * total_out_factor
+                    if amount > balance:
+                        amount = balance
+                    balance -= amount
+                    dst = out_dst[k]
+                    if dst >= 0:
+                        received[dst] += amount
+
+            balances[i] = balance
+
+        return received
+
+    def run(self, ticks):
+        for t in xrange(ticks):
+            self.step()
+        return self.balances
+
+    def steady_state(self, max_ticks=1000, tolerance=1e-9):
+        """ Ticks until the flows stop changing
+
+        Returns (inflow, rate, ticks, converged) where inflow[i] is what
+        node i receives per tick once settled and rate[i] is how much its
+        balance grows per tick (0 for nodes that leak or pass on as much
+        as they receive, the inflow itself for a goal that only fills up).
+        """
+        previous = None
+        for t in xrange(1, max_ticks + 1):
+            before = array('d', self.balances)
+            inflow = self.step()
+            rate = array('d', [ b - a for a,b in izip(before, self.balances) ])
+            current = inflow + rate
+            if previous is not None:
+                scale = max([1.0] + [ abs(x) for x in current ])
+                change = max([0.0] + [ abs(a - b) for a,b in izip(previous, current) ])
+                if change <= tolerance * scale:
+                    return inflow, rate, t, True
+            previous = current
+        return inflow, rate, max_ticks, False
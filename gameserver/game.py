@@ -1,19 +1,27 @@
 import logging.config
 import json
 from datetime import datetime, timedelta
+from heapq import nlargest
 from time import time
 
 from models import Node, Player, Edge, Settings, Client, Goal, Policy, Table, Message, Budget
 from settings import APP_VERSION, TICKINTERVAL
 from utils import random, update_node_from_dict, default_uuid
 from network import Network
+from snapshot import Snapshot, published
+from profiling import tick_profiler
 from database import get_db
 
+from flask import current_app
 from flaskext.zodb import Object, List, BTree, Dict
 
 log = logging.getLogger(__name__)
 
 def get_game():
+    store = current_app.extensions.get('write_behind')
+    if store is not None:
+        return store.get_game()
+
     db = get_db()
     try:
         game = db['game']
@@ -25,6 +33,10 @@ def get_game():
         
 class Game(Object):
 
+    # set by persistence.WriteBehindStore, everything the API can change is
+    # appended to it so it can be replayed on top of the last checkpoint
+    _v_journal = None
+
     def __init__(self, id):
         self.id = id
         self.tables = BTree()
@@ -37,6 +49,11 @@ class Game(Object):
         pass
 #        self.network = Network()
 
+    def _journal(self, op, **args):
+        journal = self._v_journal
+        if journal is not None:
+            self.settings.journal_seq = journal.append(op, args)
+
     @property
     def default_offer_price(self):
         # set default offer price to 20% of max spend per year
@@ -45,13 +62,16 @@ class Game(Object):
     def get_messages(self):
         return self.messages.values()
 
-    def add_message(self, timestamp, type, message):
-        m = Message(id=default_uuid(), timestamp=timestamp, type=type, message=message)
+    def add_message(self, timestamp, type, message, id=None):
+        m = Message(id=id or default_uuid(), timestamp=timestamp, type=type, message=message)
         self.messages[m.id] = m
+        self._journal('add_message', id=m.id, timestamp=timestamp.isoformat(),
+                      type=type, message=message)
         return m
 
     def clear_messages(self):
         self.messages = {}
+        self._journal('clear_messages')
 
     def validate_api_key(self, token):
         client = self.clients.get(token)
@@ -69,8 +89,7 @@ class Game(Object):
         return list(self.network.ranked_nodes)
     
     def do_leak(self):
-        for node in self.get_ranked_nodes():
-            node.do_leak()
+        self.network.leak()
 
     @property
     def total_players_inflow(self):
@@ -91,30 +110,93 @@ class Game(Object):
         players = self.network.players.values()
         for player in players:
             player.unclaimed_budget = self.settings.budget_per_cycle
-
-    def tick(self):
-        t1 = time()
-        self.do_leak()
-        t2 = time()
-        self.do_propogate_funds()
-        t3 = time()
-        log.debug("leak: {:.2f}".format(t2-t1))
-        log.debug("propogate: {:.2f}".format(t3-t2))
+        self._journal('replenish_budget')
+
+    def tick(self, ticks=1):
+        # ticks run back to back against the same cached plan and funders
+        # index, nothing is persisted until the surrounding transaction commits
+        if ticks < 1:
+            raise ValueError, "Number of ticks must be at least 1"
+        t0 = time()
+        leak = fund = propagate = 0.0
+        for i in xrange(ticks):
+            t1 = time()
+            self.do_leak()
+            t2 = time()
+            self.network.fund_network()
+            t3 = time()
+            self.network.propagate()
+            t4 = time()
+            log.debug("leak: {:.2f}".format(t2-t1))
+            log.debug("propogate: {:.2f}".format(t4-t2))
+            leak += t2 - t1
+            fund += t3 - t2
+            propagate += t4 - t3
+        self.settings.tick_seq += ticks
+
+        nodes = self.network.ranked_nodes
+        # left for publish_tick, only the caller knows if the tick is committed
+        self._v_tick_profile = dict(
+            seq=self.settings.tick_seq,
+            ticks=ticks,
+            leak=leak,
+            fund_network=fund,
+            propagate=propagate,
+            total=time() - t0,
+            nodes=len(nodes),
+            edges=len(self.network.edges),
+            wallet_entries=sum(len(n.wallet) for n in nodes if n.wallet is not None),
+            players=len(self.network.players))
+        self._journal('tick', ticks=ticks)
+        return self.settings.tick_seq
+
+    def publish_tick(self):
+        """ Publish a snapshot and profile of the last tick once it commits
+
+        Called by whoever commits the tick, replays and benchmarks that
+        tick without committing leave nothing behind.
+        """
+        t0 = time()
+        published.publish_on_commit(Snapshot(self))
+        profile = getattr(self, '_v_tick_profile', None)
+        if profile is not None:
+            del self._v_tick_profile
+            profile['snapshot'] = time() - t0
+            profile['total'] += profile['snapshot']
+            tick_profiler.record_on_commit(profile)
+
+    def get_snapshot(self):
+        """ The published snapshot if it is still current, else None """
+        # through the game so the snapshot module is the one its class was
+        # imported with, gameserver.game and game are separate modules
+        return published.get(self)
+
+    def pin_snapshot(self):
+        """ Serve this thread the published snapshot, if any, until unpinned """
+        return published.pin()
+
+    def unpin_snapshot(self):
+        published.unpin()
+
+    def _network_changed(self):
+        # other workers check network_seq before serving their snapshots
+        published.invalidate()
+        self.settings.network_seq += 1
 
     def top_players(self, max_num=20):
         pf = self.goal_funded_by_player
-        return sorted(self.network.players.values(), key=lambda x: pf(x.id), reverse=True)[:max_num]
+        return nlargest(max_num, self.network.players.values(), key=lambda x: pf(x.id))
 
     def clear_players(self):
-        self.network.players = {}
+        self._network_changed()
+        self.network.clear_players()
+        self._journal('clear_players')
 
     def clear_network(self):
-        self.clear_players()
-
-        self.network.policies = {}
-        self.network.goals = {}
-        self.network.edges = {}
-        self.network.rank()
+        self._network_changed()
+        self.network.clear_players()
+        self.network.clear()
+        self._journal('clear_network')
 
 
     def create_player(self, name, **kwargs):
@@ -129,7 +211,11 @@ class Game(Object):
         for k,v in kwargs.items():
             setattr(p, k, v)
 
-        self.network.players[p.id] = p
+        self.network.add_node(p)
+        self._network_changed()
+        self._journal('create_player', name=name, id=p.id, token=p.token,
+                      goal_id=p.goal_id, policies=dict(p.policies),
+                      balance=p.balance, max_outflow=p.max_outflow)
 
         return p
 
@@ -145,9 +231,8 @@ class Game(Object):
 
     def add_policy(self, name, **kwargs):
         p = Policy.new(name, **kwargs)
-        self.network.policies[p.id] = p
-        self.network.rank()
-        return p
+        published.invalidate()
+        return self.network.add_node(p)
 
     def get_policy(self, id):
         return self.network.policies.get(id)
@@ -169,6 +254,7 @@ class Game(Object):
         if data['seller_id'] == '89663963-fada-11e6-9949-0c4de9cfe672' and \
                 data['policy_id'] == '701a46d9-fadf-11e6-a390-040ccee13a9a':
             buyer.balance = buyer.balance + 200000
+            self._journal('buy_policy', buyer_id=buyer_id, data=data)
             return True
         price = data['price']
         chk = data['checksum']
@@ -176,13 +262,16 @@ class Game(Object):
         if not (buyer and seller and policy):
             raise ValueError, "Cannot find buyer, seller, or policy"
 
-        return buyer.buy_policy(seller, policy, price, chk)
+        bought = buyer.buy_policy(seller, policy, price, chk)
+        # the new policy starts unfunded, keep the funders index in step
+        self.network.set_funding(buyer, policy.id, buyer.policies[policy.id])
+        self._journal('buy_policy', buyer_id=buyer_id, data=data)
+        return bought
 
     def add_goal(self, name, **kwargs):
         g = Goal.new(name, **kwargs)
-        self.network.goals[g.id] = g
-        self.network.rank()
-        return g
+        published.invalidate()
+        return self.network.add_node(g)
 
     def get_goal(self, id):
         return self.network.goals[id]
@@ -191,7 +280,10 @@ class Game(Object):
         return self.network.goals.values()
 
     def get_node(self, id):
-        return self.network.nodes.get(id)
+        return self.network.get_node(id)
+
+    def get_node_type(self, id):
+        return self.network.get_node_type(id)
 
     def get_wallets_by_location(self, id):
         node = self.get_node(id)
@@ -218,8 +310,13 @@ class Game(Object):
 
     def add_link(self, a, b, weight):
         l = Edge.new(a, b, weight)
+        try:
+            self.network.rank_edge(l)
+        except ValueError:
+            l.unlink()
+            raise
         self.network.edges[l.id] = l
-        self.network.rank()
+        published.invalidate()
         return l
 
     def get_links(self):
@@ -227,21 +324,74 @@ class Game(Object):
 
     def get_link(self, id):
         return self.network.edges.get(id)
+
+    def batch(self):
+        """ Bulk add nodes and links, re-ranking once at the end
+
+        with game.batch() as batch:
+            p = batch.add_policy('Policy 1')
+            g = batch.add_goal('Goal 1')
+            batch.add_link(p, g, 1.0)
+        """
+        return self.network.batch()
+
+    def _load_network_data(self, batch, data):
+        for cls, key in ((Policy, 'policies'), (Goal, 'goals')):
+            for node_data in data.get(key) or []:
+                node = cls(id=node_data.get('id') or default_uuid())
+                update_node_from_dict(node, node_data)
+                batch.add_node(node)
+                # record generated ids so journalled data replays the same
+                node_data['id'] = node.id
+
+                for conn in node_data.get('connections') or []:
+                    l = batch.add_link(conn['from_id'], conn['to_id'], conn['weight'],
+                                       id=conn.get('id'))
+                    conn['id'] = l.id
+
+    def forecast(self, ticks):
+        if ticks < 1:
+            raise ValueError, "Number of ticks must be at least 1"
+        balances = self.network.forecast(ticks)
+        return dict(goals=[ (g.id, balances[g.id]) for g in self.get_goals() ],
+                    policies=[ (p.id, balances[p.id]) for p in self.get_policies() ])
+
+    def steady_state(self, max_ticks=1000):
+        if max_ticks < 1:
+            raise ValueError, "Number of ticks must be at least 1"
+        flows, converged = self.network.steady_state(max_ticks)
+        return dict(converged=converged,
+                    goals=[ (g.id,) + flows[g.id] for g in self.get_goals() ],
+                    policies=[ (p.id,) + flows[p.id] for p in self.get_policies() ])
+
+    def add_to_network(self, data):
+        published.invalidate()
+        with self.batch() as batch:
+            self._load_network_data(batch, data)
+        self._journal('add_to_network', data=data)
     
     def set_policy_funding_for_player(self, player, fundings):
         total = sum([ x for (_,x) in fundings ])
         if total > self.settings.max_spend_per_tick:
             raise ValueError, "Sum of funds exceeds max allowed for player"
         for policy_id, amount in fundings:
-            player.policies[policy_id] = amount
+            self.network.set_funding(player, policy_id, amount)
+        self._journal('set_funding', player_id=player.id, fundings=list(fundings))
         return player.policies
 
+    def claim_budget(self, player):
+        player.claim_budget()
+        self._journal('claim_budget', player_id=player.id)
+
     def get_policy_funding_for_player(self, player):
         return sorted(player.policies.items())
 
-    def create_table(self, name):
+    def create_table(self, name, id=None):
         table = Table.new(name=name)
+        if id is not None:
+            table.id = id
         self.tables[table.id] = table
+        self._journal('create_table', name=name, id=table.id)
         return table
 
     def get_table(self, id):
@@ -250,9 +400,10 @@ class Game(Object):
     def delete_table(self, id):
         try:
             del self.tables[id]
-            return True
         except KeyError:
             return False
+        self._journal('delete_table', id=id)
+        return True
 
     def get_tables(self):
         return self.tables
@@ -261,11 +412,13 @@ class Game(Object):
         self.tables[table_id].players.add(player_id)
         self.tables[table_id]._p_changed = 1
         self.network.players[player_id].table_id = table_id
+        self._journal('add_player_to_table', player_id=player_id, table_id=table_id)
 
     def remove_player_from_table(self, player_id, table_id):
         self.tables[table_id].players.remove(player_id)
         self.tables[table_id]._p_changed = 1
         self.network.players[player_id].table_id = None
+        self._journal('remove_player_from_table', player_id=player_id, table_id=table_id)
 
     def clear_table(self, table_id):
         table = self.get_table(table_id)
@@ -289,50 +442,12 @@ class Game(Object):
         return self.get_network(table.players)
 
     def create_network(self, data):
-        
-        goals = data['goals']
-        policies = data['policies']
-
-        id_mapping = {}
-        links = []
-
+        self._network_changed()
         network = Network()
-        
-        for policy in policies:
-            p = Policy(id=policy['id'])
-            update_node_from_dict(p, policy)
-            id_mapping[policy['id']] = p
-            network.policies[p.id] = p
-
-            for conn in policy['connections']:
-                i = conn['id']
-                a = conn['from_id']
-                b = conn['to_id']
-                w = conn['weight']
-                links.append((i,a,b,w))
-
-        for goal in goals:
-            g = Goal(id=goal['id'])
-            update_node_from_dict(g, goal)
-            id_mapping[goal['id']] = g
-            network.goals[g.id] = g
-
-            for conn in goal['connections']:
-                i = conn['id']
-                a = conn['from_id']
-                b = conn['to_id']
-                w = conn['weight']
-                links.append((i,a,b,w))
-
-        for i,a,b,w in links:
-            a = id_mapping[a]
-            b = id_mapping[b]
-            l = Edge(id=i)
-            l.init(a,b,w)
-            network.edges[l.id] = l
-
-        network.rank()
+        with network.batch() as batch:
+            self._load_network_data(batch, data)
         self.network = network
+        self._journal('create_network', data=data)
 
     def get_network_for_player(self, player):
 
@@ -392,33 +507,40 @@ class Game(Object):
     def update_network(self, network):
         goals = network['goals']
         policies = network['policies']
-        links = []
 
-        futures = []
+        # look everything up first so an unknown id changes nothing
+        nodes = []
+        links = []
         for node in goals+policies:
             n = self.get_node(node['id'])
             if not n:
                 return "node id {id} name {name} not found in network".format(**node)
-            update_node_from_dict(n, node)
+            nodes.append((n, node))
 
             for conn in node.get('connections', []):
-                links.append(conn)
+                l = self.get_link(conn['id'])
+                if not l:
+                    return "link id {id} not found in network".format(**conn)
+                links.append((l, conn))
+
+        published.invalidate()
+        for n, node in nodes:
+            update_node_from_dict(n, node)
 
-        for link in links:
-            l = self.get_link(link['id'])
-            if not l:
-                return "link id {id} not found in network".format(**link)
+        for l, link in links:
             l.weight = link['weight']
 
+        self.network.compile()
         self.populate()
+        self._journal('update_network', network=network)
         
-    def start(self, start_year, end_year, duration, budget_per_player):
+    def start(self, start_year, end_year, duration, budget_per_player, now=None):
         years_to_play = end_year - start_year
         budget_per_player_per_year = budget_per_player / years_to_play
         seconds_per_year = duration*60*60 / years_to_play
 
         td = timedelta(seconds=seconds_per_year)
-        now = datetime.now()
+        now = now or datetime.now()
         next_game_year_start = now + td
 
         if not hasattr(self, 'settings'):
@@ -429,12 +551,15 @@ class Game(Object):
         self.settings.next_game_year_start = next_game_year_start
         self.settings.budget_per_cycle = budget_per_player_per_year
         self.settings.max_spend_per_tick = budget_per_player_per_year / (seconds_per_year / TICKINTERVAL)
+        self._journal('start', start_year=start_year, end_year=end_year, duration=duration,
+                      budget_per_player=budget_per_player, now=now.isoformat())
 
         return start_year
 
     def stop(self):
         year = self.settings.current_game_year
         self.settings.next_game_year_start = None
+        self._journal('stop')
         return year
 
     def current_year(self):
@@ -1,12 +1,15 @@
 import logging.config
 import os
 
-from flask import Flask, Blueprint, request
+from flask import Flask, Blueprint, Response, request
 
 import connexion
 
 import settings
 from database import get_db
+from scheduler import TickScheduler
+from metrics import metrics
+from persistence import Journal, WriteBehindStore
 
 log = logging.getLogger(__name__)
 
@@ -28,21 +31,44 @@ def cors_after_request(resp):
     resp.headers['Access-Control-Allow-Methods'] = methods_allow
     return resp
 
+def metrics_view():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 def create_app():
     app = connexion.App(__name__, specification_dir='./')
-    app.add_api('swagger.yaml', arguments={'title': 'An API for the game server allowing mobile app to interact with players, etc'})
+    api = app.add_api('swagger.yaml', arguments={'title': 'An API for the game server allowing mobile app to interact with players, etc'})
     configure_app(app.app)
     with app.app.app_context():
         db = get_db()
+        metrics.instrument_zodb(db)
         db.init_app(app.app)
 
+    if settings.PERSISTENCE == 'write_behind':
+        store = WriteBehindStore(None, Journal(settings.JOURNAL_PATH),
+                                 settings.CHECKPOINT_INTERVAL)
+        store.init_app(app.app)
+
+    metrics.register_operations(api.specification)
+    app.app.extensions['metrics'] = metrics
+    app.app.before_request(metrics.before_request)
+    app.app.wsgi_app = metrics.middleware(app.app.wsgi_app)
+    app.app.add_url_rule('/metrics', 'metrics', metrics_view)
+
     app.app.after_request(cors_after_request)
     return app.app
 
 app = create_app()
 
 def main(): # pragma: no cover
-    app = create_app()
+    # serves the app built above, building another would open a second
+    # journal and write-behind store on the same files
+
+    # with the debug reloader only the child process serves requests
+    if settings.TICK_SCHEDULER and (not settings.FLASK_DEBUG or
+                                    os.environ.get('WERKZEUG_RUN_MAIN') == 'true'):
+        scheduler = TickScheduler(app)
+        app.extensions['tick_scheduler'] = scheduler
+        scheduler.start()
     log.info('>>>>> Starting development server at http://{}/api/ <<<<<'.format(app.config['SERVER_NAME']))
     app.run(debug=settings.FLASK_DEBUG)
 
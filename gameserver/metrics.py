@@ -0,0 +1,179 @@
+import logging.config
+import threading
+from bisect import bisect_left
+from time import time
+
+import transaction
+from flask import request
+from ZODB.POSException import ConflictError
+
+log = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+
+OPERATION_KEY = 'gameserver.operation'
+
+
+def _labels(names, values):
+    return ','.join('{}="{}"'.format(n, str(v).replace('"', '\\"'))
+                    for n,v in zip(names, values))
+
+
+class Histogram(object):
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def lines(self, name, labels):
+        prefix = labels + ',' if labels else ''
+        total = 0
+        for le, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            yield '{}_bucket{{{}le="{}"}} {}'.format(name, prefix, le, total)
+        yield '{}_sum{{{}}} {}'.format(name, labels, repr(self.sum))
+        yield '{}_count{{{}}} {}'.format(name, labels, total)
+
+
+class Metrics(object):
+    """ Request and ZODB metrics in the Prometheus text exposition format
+
+    Requests are labelled with the swagger operationId they were routed
+    to. Recording is a dict lookup and a few additions under a lock.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.operations = {}
+        self.requests = {}
+        self.latency = {}
+        self.sizes = {}
+        self.commits = 0
+        self.conflicts = 0
+        self.aborts = 0
+        self.dropped_ticks = 0
+
+    def register_operations(self, specification):
+        # connexion names flask endpoints after the operationId with dots
+        # replaced, see connexion.utils.flaskify_endpoint
+        for methods in specification.get('paths', {}).values():
+            for operation in methods.values():
+                if isinstance(operation, dict) and 'operationId' in operation:
+                    operation_id = operation['operationId']
+                    self.operations[operation_id.replace('.', '_')] = operation_id
+
+    def operation_for(self, endpoint):
+        if endpoint is None:
+            return 'unknown'
+        name = endpoint.rsplit('.', 1)[-1]
+        return self.operations.get(name, name)
+
+    def observe(self, operation, method, status, duration, size):
+        with self._lock:
+            key = (operation, method, status)
+            self.requests[key] = self.requests.get(key, 0) + 1
+            latency = self.latency.get(operation)
+            if latency is None:
+                latency = self.latency[operation] = Histogram(LATENCY_BUCKETS)
+                self.sizes[operation] = Histogram(SIZE_BUCKETS)
+            latency.observe(duration)
+            self.sizes[operation].observe(size)
+
+    def render(self):
+        with self._lock:
+            lines = ['# HELP gameserver_requests_total Requests handled by operationId, method and status',
+                     '# TYPE gameserver_requests_total counter']
+            for key, count in sorted(self.requests.items()):
+                lines.append('gameserver_requests_total{{{}}} {}'.format(
+                    _labels(('operation', 'method', 'status'), key), count))
+
+            for name, help, histograms in (
+                    ('gameserver_request_duration_seconds', 'Request latency including the ZODB commit', self.latency),
+                    ('gameserver_response_size_bytes', 'Response body size', self.sizes)):
+                lines.append('# HELP {} {}'.format(name, help))
+                lines.append('# TYPE {} histogram'.format(name))
+                for operation, histogram in sorted(histograms.items()):
+                    lines.extend(histogram.lines(name, _labels(('operation',), (operation,))))
+
+            for name, help, value in (
+                    ('gameserver_zodb_commits_total', 'Request transactions committed', self.commits),
+                    ('gameserver_zodb_conflicts_total', 'Request transactions that failed with an unresolved ConflictError', self.conflicts),
+                    ('gameserver_zodb_aborts_total', 'Request transactions aborted', self.aborts),
+                    ('gameserver_ticks_dropped_total', 'Scheduled ticks missed or lost to conflicts', self.dropped_ticks)):
+                lines.append('# HELP {} {}'.format(name, help))
+                lines.append('# TYPE {} counter'.format(name))
+                lines.append('{} {}'.format(name, value))
+        return '\n'.join(lines) + '\n'
+
+    def instrument_zodb(self, db):
+        """ Count the outcome of the commit flaskext.zodb does at teardown
+
+        Must be called before db.init_app as that registers close_db.
+        """
+        close_db = db.close_db
+
+        def counted_close_db(exception):
+            if not db.is_connected:
+                return close_db(exception)
+            committing = exception is None and not transaction.isDoomed()
+            try:
+                close_db(exception)
+            except ConflictError:
+                self.count_conflict()
+                raise
+            with self._lock:
+                if committing:
+                    self.commits += 1
+                else:
+                    self.aborts += 1
+
+        db.close_db = counted_close_db
+
+    def count_conflict(self):
+        with self._lock:
+            self.conflicts += 1
+
+    def count_dropped_ticks(self, ticks):
+        with self._lock:
+            self.dropped_ticks += ticks
+
+    def before_request(self):
+        endpoint = request.url_rule.endpoint if request.url_rule else None
+        request.environ[OPERATION_KEY] = self.operation_for(endpoint)
+
+    def middleware(self, wsgi_app):
+        """ WSGI wrapper timing whole requests, teardown and commit included """
+        def app(environ, start_response):
+            start = time()
+            status = ['500']
+
+            def metrics_start_response(s, headers, exc_info=None):
+                status[0] = s.split(' ', 1)[0]
+                return start_response(s, headers, exc_info)
+
+            try:
+                iterable = wsgi_app(environ, metrics_start_response)
+                try:
+                    # the API only returns buffered responses so this is cheap
+                    body = list(iterable)
+                finally:
+                    if hasattr(iterable, 'close'):
+                        iterable.close()
+            except Exception:
+                self.observe(environ.get(OPERATION_KEY, 'unknown'),
+                             environ.get('REQUEST_METHOD'), '500', time() - start, 0)
+                raise
+            self.observe(environ.get(OPERATION_KEY, 'unknown'),
+                         environ.get('REQUEST_METHOD'), status[0],
+                         time() - start, sum(len(chunk) for chunk in body))
+            return body
+        return app
+
+
+metrics = Metrics()
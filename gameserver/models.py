@@ -3,12 +3,49 @@ from datetime import datetime
 
 from utils import default_uuid
 from utils import pack_amount, checksum
-from wallet import Wallet
+from wallet import Wallet, merge_changes
 
+from ZODB.POSException import ConflictError
 from flaskext.zodb import Object, List, Dict
 
 log = logging.getLogger(__name__)
 
+_missing = object()
+
+def resolve_attributes(old, committed, new, resolvers={}):
+    """ Three way merge of persistent states for _p_resolveConflict
+
+    An attribute changed by only one of the transactions takes its value.
+    One both changed goes to its resolver in resolvers, called with (old,
+    committed, new), and is otherwise a conflict unless both set the same
+    value.
+    """
+    res = {}
+    for name in set(old) | set(committed) | set(new):
+        o = old.get(name, _missing)
+        c = committed.get(name, _missing)
+        n = new.get(name, _missing)
+        try:
+            if c == o:
+                value = n
+            elif n == o:
+                value = c
+            elif name in resolvers:
+                value = resolvers[name](*[ None if x is _missing else x for x in (o, c, n) ])
+            elif c == n:
+                value = n
+            else:
+                raise ConflictError
+        except ValueError:
+            # persistent references that can't be compared
+            raise ConflictError
+        if value is not _missing:
+            res[name] = value
+    return res
+
+def _add_changes(old, committed, new):
+    return (committed or 0) + (new or 0) - (old or 0)
+
 class Hashable:
     def __hash__(self):
         return hash(self.id)
@@ -31,6 +68,21 @@ class Settings(Base):
     next_game_year_start = None
     budget_per_cycle = None
     max_spend_per_tick = None
+    tick_seq = 0
+    journal_seq = 0
+    # bumped whenever the network is replaced or players come and go, so
+    # snapshots taken before can be told apart, see snapshot.Published
+    network_seq = 0
+
+    def _p_resolveConflict(self, old, committed, new):
+        # two ticks are never merged, summing their changes matches no
+        # order they could have run in. The later one fails and is retried
+        # on top of the other, so wallet merges in NodeState only ever
+        # combine a tick with other requests' writes.
+        def ticks(old, committed, new):
+            raise ConflictError
+        return resolve_attributes(old, committed, new, {'tick_seq': ticks,
+                                                         'network_seq': _add_changes})
 
 
 class Funding:
@@ -77,6 +129,31 @@ class Table(Base):
         t.players = set()
         return t
 
+    def _p_resolveConflict(self, old, committed, new):
+        def players(old, committed, new):
+            old = old or set()
+            return (committed - (old - new)) | (new - old)
+        return resolve_attributes(old, committed, new, {'players': players})
+
+class NodeState(Object):
+    """ The numbers a tick changes on a node
+
+    Kept in a record of its own so a tick only writes these and never
+    re-pickles the node with its name and edge lists.
+    """
+    wallet = None
+    active_level = 0.0
+
+    def __init__(self, wallet=None):
+        self.wallet = wallet
+
+    def _p_resolveConflict(self, old, committed, new):
+        # the last write of active_level wins, it is recalculated every tick
+        return resolve_attributes(old, committed, new,
+                                  {'wallet': merge_changes,
+                                   'active_level': lambda o, c, n: n})
+
+
 class Node(Base):
 
     name = None
@@ -85,8 +162,7 @@ class Node(Base):
     leak = 0.0
     activation = 0.0
     max_level = 0.0
-    active_level = 0.0
-    wallet = None
+    _state = None
     
     def __eq__(self, other):
         try:
@@ -114,6 +190,36 @@ class Node(Base):
             setattr(n, k, v)
         return n
 
+    @property
+    def state(self):
+        state = self._state
+        if state is None:
+            # nodes stored before the state was split out kept it themselves
+            attrs = self.__dict__
+            state = NodeState(attrs.pop('wallet', None))
+            if 'active_level' in attrs:
+                state.active_level = attrs.pop('active_level')
+            self._state = state
+        return state
+
+    def __setattr__(self, name, value):
+        # Persistent marks the node changed on any set, so route the tick
+        # state around it
+        if name == 'wallet' or name == 'active_level':
+            setattr(self.state, name, value)
+        elif name == 'balance':
+            self.state.wallet = Wallet([(self.id, value)])
+        else:
+            Base.__setattr__(self, name, value)
+
+    @property
+    def wallet(self):
+        return self.state.wallet
+
+    @property
+    def active_level(self):
+        return self.state.active_level
+
     @property
     def lower_neighbors(self):
         return [x.lower_node for x in self.lower_edges]
@@ -155,10 +261,6 @@ class Node(Base):
         else:
             return 0.0
 
-    @balance.setter
-    def balance(self, amount):
-        self.wallet = Wallet([(self.id, amount)])
-
     def do_leak(self):
         leak = self.get_leak()
         if self.balance and leak:
@@ -173,11 +275,19 @@ class Node(Base):
 
     @property
     def rank(self):
-        rank = 1
-        for parent in self.parents:
-            rank += parent.rank
+        # 1 + the longest chain of parents above this node, with each
+        # ancestor only visited once
+        ranks = {}
+
+        def rank_of(node):
+            if node.id not in ranks:
+                ranks[node.id] = None
+                ranks[node.id] = 1 + max([ rank_of(p) for p in node.parents ] or [0])
+            elif ranks[node.id] is None:
+                raise ValueError, "Network contains a cycle"
+            return ranks[node.id]
 
-        return rank
+        return rank_of(self)
 
 
 class Edge(Base):
@@ -194,9 +304,14 @@ class Edge(Base):
         n2.higher_edges.append(self)
         
         self.weight = weight
-        self.wallet = None
         return self
 
+    def unlink(self):
+        self.higher_node.lower_edges.remove(self)
+        self.lower_node.higher_edges.remove(self)
+        self.higher_node._p_changed = True
+        self.lower_node._p_changed = True
+
     @property
     def current_flow(self):
         return self.lower_node.current_outflow
@@ -224,6 +339,11 @@ class Player(Node):
     
     goal_id = None
     table_id = None
+
+    def _p_resolveConflict(self, old, committed, new):
+        # claiming and replenishing the budget both set it, so that is
+        # left as a conflict and the request retried
+        return resolve_attributes(old, committed, new)
     
     @property
     def funded_policies(self):
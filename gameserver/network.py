@@ -1,12 +1,28 @@
 import logging.config
-from itertools import chain
+from bisect import bisect
+from collections import deque
+from itertools import chain, izip
 from time import time
 
-from wallet import Wallet
+from models import Node, Goal, Policy, Player, Edge, resolve_attributes, _add_changes
+from utils import default_uuid
+from wallet import Wallet, player_key
+from engine import PropagationPlan, Forecast
 from flaskext.zodb import Object, List, BTree
 
 log = logging.getLogger(__name__)
 
+NODE_POLICY = 'policy'
+NODE_GOAL = 'goal'
+NODE_PLAYER = 'player'
+
+def node_type(node):
+    if isinstance(node, Player):
+        return NODE_PLAYER
+    elif isinstance(node, Goal):
+        return NODE_GOAL
+    return NODE_POLICY
+
 def convert_to_dict(l):
     if type(l) == type({}):
         return BTree(l)
@@ -16,8 +32,103 @@ def convert_to_dict(l):
         return BTree()
     
 
+class NetworkBatch(object):
+    """ Collects policy, goal and link additions to apply in one go
+
+    Nothing touches the network until commit(), which validates all the
+    additions together and re-ranks the network once. Used as a context
+    manager the batch commits on a clean exit, and a commit that fails
+    validation raises ValueError and leaves the network unchanged.
+    """
+
+    def __init__(self, network):
+        self.network = network
+        self.nodes = []
+        self.links = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+
+    def add_node(self, node):
+        self.nodes.append(node)
+        return node
+
+    def add_policy(self, name, **kwargs):
+        return self.add_node(Policy.new(name, **kwargs))
+
+    def add_goal(self, name, **kwargs):
+        return self.add_node(Goal.new(name, **kwargs))
+
+    def add_link(self, a, b, weight, id=None):
+        """ a and b may be nodes or the ids of existing or batched nodes """
+        l = Edge(id=id or default_uuid())
+        self.links.append((l, a, b, weight))
+        return l
+
+    def validate(self):
+        network = self.network
+        pending = {}
+        for node in self.nodes:
+            if node.id in pending or node.id in network.policies or \
+                    node.id in network.goals:
+                raise ValueError, "Duplicate node id {}".format(node.id)
+            pending[node.id] = node
+
+        def resolve(node):
+            if isinstance(node, Node):
+                node = node.id
+            return pending.get(node) or network.policies.get(node) or \
+                network.goals.get(node)
+
+        links = []
+        seen = set()
+        for l,a,b,weight in self.links:
+            if l.id in seen or l.id in network.edges:
+                raise ValueError, "Duplicate link id {}".format(l.id)
+            seen.add(l.id)
+            higher, lower = resolve(a), resolve(b)
+            if higher is None or lower is None:
+                raise ValueError, "Link {} refers to an unknown node".format(l.id)
+            links.append((l, higher, lower, weight))
+
+        return links
+
+    def commit(self):
+        network = self.network
+        links = self.validate()
+
+        for node in self.nodes:
+            network.add_node(node, rank=False)
+        for l,a,b,weight in links:
+            l.init(a, b, weight)
+            network.edges[l.id] = l
+
+        try:
+            network.rank()
+        except ValueError:
+            for l,a,b,weight in links:
+                l.unlink()
+                del network.edges[l.id]
+            for node in self.nodes:
+                network.remove_node(node, rank=False)
+            network.rank()
+            raise
+
+        self.nodes = []
+        self.links = []
+
+
 class Network(Object):
 
+    # bumped by compile() whenever the ranked nodes or their edges change
+    version = 0
+    # policy id -> BTree of player id -> (key, amount), see funders
+    _funders = None
+
     def __init__(self, policies=None, goals=None, edges=None, players=None):
         self.policies = convert_to_dict(policies)
         self.goals = convert_to_dict(goals)
@@ -26,6 +137,9 @@ class Network(Object):
         self.ranked_nodes = []
         self.rank()
 
+    def _p_resolveConflict(self, old, committed, new):
+        return resolve_attributes(old, committed, new, {'version': _add_changes})
+
     @property
     def total_player_inflow(self):
         return sum([ p.max_outflow or 0 for p in self.players.values() ])
@@ -36,40 +150,321 @@ class Network(Object):
                     list(self.goals.items()) +
                     list(self.players.items()))
 
+    def _tree(self, type):
+        return {NODE_POLICY: self.policies,
+                NODE_GOAL: self.goals,
+                NODE_PLAYER: self.players}[type]
+
+    @property
+    def index(self):
+        """ Map of node id to (node type, node) for every node """
+        index = getattr(self, '_v_index', None)
+        if index is None:
+            index = {}
+            for type in (NODE_POLICY, NODE_GOAL, NODE_PLAYER):
+                for node in self._tree(type).values():
+                    index[node.id] = (type, node)
+            self._v_index = index
+        return index
+
+    def _lookup(self, id):
+        index = self.index
+        entry = index.get(id)
+        if entry is None:
+            # nodes written straight into the trees bypass the index
+            for type in (NODE_POLICY, NODE_GOAL, NODE_PLAYER):
+                node = self._tree(type).get(id)
+                if node is not None:
+                    entry = index[id] = (type, node)
+                    break
+        return entry
+
+    def get_node(self, id):
+        entry = self._lookup(id)
+        if entry is not None:
+            return entry[1]
+
+    def get_node_type(self, id):
+        entry = self._lookup(id)
+        if entry is not None:
+            return entry[0]
+
+    def add_node(self, node, rank=True):
+        type = node_type(node)
+        self._tree(type)[node.id] = node
+        self.index[node.id] = (type, node)
+        if type == NODE_PLAYER:
+            for policy_id, amount in node.policies.items():
+                self._index_funding(node, policy_id, amount)
+        elif rank:
+            self.rank_node(node)
+        return node
+
+    def remove_node(self, node, rank=True):
+        type = node_type(node)
+        del self._tree(type)[node.id]
+        self.index.pop(node.id, None)
+        if type == NODE_PLAYER:
+            for policy_id in node.policies.keys():
+                self._index_funding(node, policy_id, 0)
+        elif rank:
+            self.rank()
+
+    def clear_players(self):
+        self.players = BTree()
+        self._v_index = None
+        self._funders = BTree()
+
+    def clear(self):
+        self.policies = BTree()
+        self.goals = BTree()
+        self.edges = BTree()
+        self._v_index = None
+        self.rank()
+
+    @property
+    def levels(self):
+        """ Map of node id to depth: 0 for roots, else 1 + deepest parent """
+        levels = getattr(self, '_v_levels', None)
+        if levels is None:
+            levels = self._v_levels = self._topological_levels()
+        return levels
+
+    def _topological_levels(self):
+        # Kahn's algorithm, counting only edges between policies and goals
+        nodes = list(self.policies.values()) + list(self.goals.values())
+        indegree = dict.fromkeys([ n.id for n in nodes ], 0)
+        for node in nodes:
+            for edge in node.lower_edges:
+                child_id = edge.lower_node.id
+                if child_id in indegree:
+                    indegree[child_id] += 1
+
+        levels = dict.fromkeys(indegree, 0)
+        queue = deque([ n for n in nodes if not indegree[n.id] ])
+        seen = 0
+        while queue:
+            node = queue.popleft()
+            seen += 1
+            level = levels[node.id] + 1
+            for edge in node.lower_edges:
+                child_id = edge.lower_node.id
+                if child_id not in indegree:
+                    continue
+                if levels[child_id] < level:
+                    levels[child_id] = level
+                indegree[child_id] -= 1
+                if not indegree[child_id]:
+                    queue.append(edge.lower_node)
+
+        if seen != len(nodes):
+            raise ValueError, "Network contains a cycle"
+        return levels
+
+    def get_level(self, node_id):
+        return self.levels[node_id]
+
+    def get_rank(self, node_id):
+        return self.plan.index[node_id]
+
+    def _sort_ranked(self):
+        levels = self.levels
+        self.ranked_nodes = sorted(list(self.policies.values()) + list(self.goals.values()),
+                                   key=lambda x: (levels[x.id], x.id))
+        self.compile()
+
     def rank(self):
-        self.ranked_nodes = sorted(list(self.policies.values()) + list(self.goals.values()), key=lambda x: (x.rank, x.id))
+        self._v_levels = None
+        self._sort_ranked()
+
+    def batch(self):
+        return NetworkBatch(self)
+
+    def rank_node(self, node):
+        """ Slot a newly added policy or goal into the ranking """
+        if getattr(self, '_v_levels', None) is None:
+            return self.rank()
+
+        levels = self.levels
+        level = 0
+        for edge in node.higher_edges:
+            if edge.higher_node.id in levels:
+                level = max(level, levels[edge.higher_node.id] + 1)
+        levels[node.id] = level
+
+        ranked = list(self.ranked_nodes)
+        keys = [ (levels[n.id], n.id) for n in ranked ]
+        ranked.insert(bisect(keys, (level, node.id)), node)
+        self.ranked_nodes = ranked
+        self.compile()
+
+    def rank_edge(self, edge):
+        """ Update the ranking for a newly added edge
+
+        Only the lower node and its descendants can move down. Raises
+        ValueError, leaving the ranking untouched, if the edge closes a
+        cycle.
+        """
+        if getattr(self, '_v_levels', None) is None:
+            return self.rank()
+
+        levels = self.levels
+        top = edge.higher_node
+        if top.id not in levels or edge.lower_node.id not in levels:
+            return
+
+        changed = {}
+        stack = [(edge.lower_node, levels[top.id] + 1)]
+        while stack:
+            node, level = stack.pop()
+            if node.id == top.id:
+                raise ValueError, "Link would create a cycle"
+            if level <= changed.get(node.id, levels[node.id]):
+                continue
+            changed[node.id] = level
+            for e in node.lower_edges:
+                if e.lower_node.id in levels:
+                    stack.append((e.lower_node, level + 1))
+
+        if changed:
+            levels.update(changed)
+            self._sort_ranked()
+        else:
+            # the order stands but the plan holds the edge and the leak
+            # a negative edge adds to the lower node
+            self.compile()
+
+    @property
+    def plan(self):
+        # kept in a volatile attribute so it is never pickled, and tagged
+        # with the version it was built at so that a change committed by
+        # another connection, or an aborted one, rebuilds it
+        cached = getattr(self, '_v_plan', None)
+        if cached is None or cached[0] != self.version:
+            cached = self._v_plan = (self.version, PropagationPlan(self.ranked_nodes))
+        return cached[1]
+
+    def compile(self):
+        """ Call after changing the nodes or edges the plan is built from """
+        self.version += 1
+        return self.plan
+
+    def forecast(self, ticks):
+        """ Projected balance of every node after ticks, by id """
+        balances = Forecast.snapshot(self).run(ticks)
+        return dict(izip(self.plan.ids, balances))
+
+    def steady_state(self, max_ticks=1000):
+        """ Settled per-tick inflow and balance growth of every node, by id
+
+        Returns (flows, converged) where flows maps a node id to an
+        (inflow, rate) pair.
+        """
+        inflow, rate, ticks, converged = Forecast.snapshot(self).steady_state(max_ticks)
+        return dict(izip(self.plan.ids, izip(inflow, rate))), converged
+
+    def leak(self):
+        """ Leak every node at its precomputed rate from the plan """
+        for node, rate in izip(self.ranked_nodes, self.plan.leak):
+            if not rate:
+                continue
+            wallet = node.wallet
+            if wallet is not None and wallet.total:
+                wallet.leak(rate)
+                node.state._p_changed = True
+
+    @property
+    def funders(self):
+        """ Inverted funding index: policy id -> {player id: (key, amount)}
+
+        Only positive fundings are indexed. key is the player's wallet key
+        so a policy's incoming wallet can be built in one go. The index is
+        persistent and kept up to date by set_funding, with a BTree per
+        policy so players funding the same policy from different
+        connections don't conflict. Networks stored without it get it
+        built from the players on first use.
+        """
+        funders = self._funders
+        if funders is None:
+            funders = self._funders = BTree()
+            for player in self.players.values():
+                for policy_id, amount in player.policies.items():
+                    self._index_funding(player, policy_id, amount)
+        return funders
+
+    def _index_funding(self, player, policy_id, amount):
+        funders = self.funders
+        policy_funders = funders.get(policy_id)
+        if amount > 0:
+            if policy_funders is None:
+                policy_funders = funders[policy_id] = BTree()
+            policy_funders[player.id] = (player_key(player.id), amount)
+        elif policy_funders is not None and player.id in policy_funders:
+            # emptied trees are kept, dropping one could lose a funding
+            # added to it by a concurrent transaction
+            del policy_funders[player.id]
+
+    def set_funding(self, player, policy_id, amount):
+        player.policies[policy_id] = amount
+        self._index_funding(player, policy_id, amount)
 
     def fund_network(self):
-        for player in self.players.values():
-            for policy_id,amount in player.policies.items():
-                if amount > 0:
-                    player.balance -= amount
-                    policy = self.policies[policy_id]
-                    if not hasattr(policy, 'incoming'):
-                        policy.incoming = Wallet()
-                    policy.incoming &= Wallet([(player.id, amount)])
+        spent = {}
+        for policy_id, funders in self.funders.items():
+            if not funders:
+                continue
+            policy = self.policies[policy_id]
+            incoming = Wallet.from_entries(funders.values())
+            # volatile so parking funds for propagate doesn't dirty the node
+            if hasattr(policy, '_v_incoming'):
+                policy._v_incoming.merge(incoming)
+            else:
+                policy._v_incoming = incoming
+            for player_id, (key, amount) in funders.items():
+                spent[player_id] = spent.get(player_id, 0.0) + amount
+
+        players = self.players
+        for player_id, amount in spent.items():
+            player = players[player_id]
+            player.balance -= amount
 
     def propagate(self):
 
         total_player_inflow = self.total_player_inflow
-        for policy in self.ranked_nodes:
+        quiet_level = 0.0 if total_player_inflow > 0 else 1.0
+        plan = self.plan
+        # ids of nodes with funds waiting for them on an incoming edge
+        received = set()
+        for i, policy in enumerate(self.ranked_nodes):
+            funded = hasattr(policy, '_v_incoming')
+            if not funded and policy.id not in received and \
+                    plan.is_quiescent(i, policy, quiet_level):
+                # nothing in, nothing to pass on: skip without touching it
+                continue
+
             previous_balance = policy.balance
 
+            sources = []
             # funds coming in from players
-            if hasattr(policy, 'incoming'):
-                policy.wallet &= policy.incoming
-                del policy.incoming
+            if funded:
+                sources.append(policy._v_incoming)
+                del policy._v_incoming
 
             # funds coming in from other nodes
-            edges = policy.higher_edges
-            for edge in edges:
-                if getattr(edge, 'wallet', None):
-                    policy.wallet &= edge.wallet
-                    # delete the wallet after we get from it
-                    edge.wallet = None 
+            if policy.id in received:
+                for edge in policy.higher_edges:
+                    if getattr(edge, '_v_wallet', None):
+                        sources.append(edge._v_wallet)
+                        # delete the wallet after we get from it
+                        edge._v_wallet = None
+
+            if sources:
+                policy.wallet.merge_all(sources)
+                # wallet was changed in place so tell ZODB the state is dirty
+                policy.state._p_changed = True
 
             new_balance = policy.balance
-            max_level = policy.max_level or 0
+            max_level = plan.max_level[i]
             if max_level and new_balance > max_level:
                 # if we are over out level then remove excess
                 policy.wallet -= new_balance - max_level
@@ -80,7 +475,7 @@ class Network(Object):
                 policy.active_level = 1.0
 
             # check if we are active
-            if policy.active_level < policy.activation:
+            if policy.active_level < plan.activation[i]:
                 # not active so stop here
                 continue
             # yes we are active so distribute funds
@@ -88,7 +483,7 @@ class Network(Object):
                 continue # no balance to propogate
 
             total_balance = policy.balance
-            total_children_weight = policy.total_children_weight # XXX
+            total_children_weight = plan.children_weight[i]
 
             if not total_children_weight:
                 continue # no children weight so return
@@ -111,6 +506,7 @@ class Network(Object):
                     factored_amount = policy.balance
 
                 # create a wallet on the edge and transfer to it
-                edge.wallet = Wallet()
-                policy.wallet.transfer(edge.wallet, factored_amount)
+                edge._v_wallet = Wallet()
+                policy.wallet.transfer(edge._v_wallet, factored_amount)
+                received.add(edge.lower_node.id)
 
@@ -0,0 +1,305 @@
+import logging.config
+import marshal
+import os
+import struct
+import threading
+import zlib
+
+import dateutil.parser
+import transaction
+from flask import g, current_app
+
+from game import Game
+from settings import CHECKPOINT_INTERVAL
+from utils import default_uuid
+
+from flaskext.zodb import Dict
+
+log = logging.getLogger(__name__)
+
+
+# op codes are stored in the journal, only ever append to this
+OPS = ('tick', 'start', 'stop', 'add_message', 'clear_messages', 'create_player',
+       'set_funding', 'claim_budget', 'buy_policy', 'create_table', 'delete_table',
+       'add_player_to_table', 'remove_player_from_table', 'clear_players',
+       'clear_network', 'create_network', 'add_to_network', 'update_network',
+       'replenish_budget')
+OP_CODES = { op: code for code, op in enumerate(OPS) }
+
+MAGIC = 'GSJ\x01'
+# payload length, crc32 of everything after it, seq, op code
+HEADER = struct.Struct('<IIQB')
+
+
+class Journal(object):
+    """ Append-only log of the changes made to a game since a checkpoint
+
+    The file starts with MAGIC followed by one record per entry, a HEADER
+    and the marshalled args. seq increases by one per entry and carries
+    on across truncations so it can be compared with the journal_seq
+    saved in a checkpoint.
+    """
+
+    def __init__(self, path, fsync=False):
+        self.path = path
+        self.fsync = fsync
+        self.seq = 0
+        end = len(MAGIC)
+        for seq, op, args, end in self._records():
+            self.seq = seq
+        self._file = open(path, 'ab')
+        if self._file.tell() == 0:
+            self._write(MAGIC)
+        elif self._file.tell() > end:
+            # drop a torn write so new records aren't appended after it
+            self._file.truncate(end)
+
+    def _write(self, data):
+        self._file.write(data)
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+
+    def append(self, op, args):
+        self.seq += 1
+        payload = marshal.dumps(args)
+        body = struct.pack('<QB', self.seq, OP_CODES[op]) + payload
+        self._write(HEADER.pack(len(payload), zlib.crc32(body) & 0xffffffff,
+                                self.seq, OP_CODES[op]) + payload)
+        return self.seq
+
+    def _records(self):
+        """ (seq, op, args, end offset) for every complete record """
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'rb') as f:
+            magic = f.read(len(MAGIC))
+            if not magic:
+                return
+            if magic != MAGIC:
+                raise ValueError, "{} is not a game journal".format(self.path)
+            while True:
+                header = f.read(HEADER.size)
+                if not header:
+                    return
+                if len(header) == HEADER.size:
+                    length, crc, seq, code = HEADER.unpack(header)
+                    payload = f.read(length)
+                    if len(payload) == length and \
+                            zlib.crc32(header[8:] + payload) & 0xffffffff == crc:
+                        yield seq, OPS[code], marshal.loads(payload), f.tell()
+                        continue
+                # a torn write at the end of the file, nothing after it
+                # can have been acknowledged
+                log.warning("Ignoring incomplete journal entry")
+                return
+
+    def entries(self):
+        for seq, op, args, end in self._records():
+            yield seq, op, args
+
+    def truncate(self, seq):
+        """ Drop the entries up to and including seq """
+        self._file.close()
+        tmp = self.path + '.tmp'
+        with open(self.path, 'rb') as src, open(tmp, 'wb') as dst:
+            dst.write(MAGIC)
+            start = len(MAGIC)
+            for entry_seq, op, args, end in self._records():
+                if entry_seq > seq:
+                    src.seek(start)
+                    dst.write(src.read(end - start))
+                start = end
+            dst.flush()
+            os.fsync(dst.fileno())
+        os.rename(tmp, self.path)
+        self._file = open(self.path, 'ab')
+
+    def close(self):
+        self._file.close()
+
+
+def _parse_time(value):
+    return dateutil.parser.parse(value)
+
+
+REPLAY = {
+    'tick': lambda game, a: game.tick(a['ticks']),
+    'start': lambda game, a: game.start(a['start_year'], a['end_year'], a['duration'],
+                                        a['budget_per_player'], now=_parse_time(a['now'])),
+    'stop': lambda game, a: game.stop(),
+    'add_message': lambda game, a: game.add_message(_parse_time(a['timestamp']), a['type'],
+                                                    a['message'], id=a['id']),
+    'clear_messages': lambda game, a: game.clear_messages(),
+    'create_player': lambda game, a: game.create_player(
+        a['name'], id=a['id'], token=a['token'], goal_id=a['goal_id'],
+        policies=Dict(a['policies']), balance=a['balance'], max_outflow=a['max_outflow']),
+    'set_funding': lambda game, a: game.set_policy_funding_for_player(
+        game.get_player(a['player_id']), [ tuple(f) for f in a['fundings'] ]),
+    'claim_budget': lambda game, a: game.claim_budget(game.get_player(a['player_id'])),
+    'buy_policy': lambda game, a: game.buy_policy(a['buyer_id'], a['data']),
+    'create_table': lambda game, a: game.create_table(a['name'], id=a['id']),
+    'delete_table': lambda game, a: game.delete_table(a['id']),
+    'add_player_to_table': lambda game, a: game.add_player_to_table(a['player_id'], a['table_id']),
+    'remove_player_from_table': lambda game, a: game.remove_player_from_table(a['player_id'],
+                                                                              a['table_id']),
+    'clear_players': lambda game, a: game.clear_players(),
+    'clear_network': lambda game, a: game.clear_network(),
+    'create_network': lambda game, a: game.create_network(a['data']),
+    'add_to_network': lambda game, a: game.add_to_network(a['data']),
+    'update_network': lambda game, a: game.update_network(a['network']),
+    'replenish_budget': lambda game, a: game.do_replenish_budget(),
+}
+
+
+def replay(game, entries, after_seq=0):
+    """ Apply the journal entries newer than after_seq to game
+
+    Runs of ticks are replayed with a single Game.tick(n), which runs
+    them back to back against one compiled plan.
+    """
+    game._v_journal = None
+    count = 0
+    ticks = 0
+    for seq, op, args in entries:
+        if seq <= after_seq:
+            continue
+        if op == 'tick':
+            ticks += args['ticks']
+        else:
+            if ticks:
+                game.tick(ticks)
+                ticks = 0
+            REPLAY[op](game, args)
+        game.settings.journal_seq = seq
+        count += 1
+    if ticks:
+        game.tick(ticks)
+    return count
+
+
+class WriteBehindStore(object):
+    """ Keeps the game in memory and checkpoints it to ZODB periodically
+
+    The game is loaded once on a connection of our own and every request
+    works on those same objects, so requests no longer commit anything.
+    Changes are journalled instead and the connection is committed every
+    interval seconds, writing each changed object once however many
+    ticks changed it. On start up the journal is replayed on top of the
+    last checkpoint.
+
+    Requests are serialised on a lock taken by get_game and released at
+    the end of the request. Reads marked snapshot_read by the controllers
+    skip the lock while a snapshot is published and are served from it,
+    so they wait for neither ticks nor checkpoints. Without a db the one
+    flaskext.zodb creates from ZODB_STORAGE is used.
+    """
+
+    def __init__(self, db, journal, interval=CHECKPOINT_INTERVAL):
+        self.db = db
+        self.journal = journal
+        self.interval = interval
+        self.lock = threading.RLock()
+        self.transaction_manager = transaction.TransactionManager()
+        self.connection = None
+        self.game = None
+        self.checkpoints = 0
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def load(self):
+        """ The game as of the last checkpoint plus the journal """
+        if self.db is None:
+            self.db = current_app.extensions['zodb'].db
+        self.connection = self.db.open(transaction_manager=self.transaction_manager)
+        root = self.connection.root()
+        if 'game' not in root:
+            root['game'] = Game(default_uuid())
+        game = root['game']
+
+        replayed = replay(game, self.journal.entries(), game.settings.journal_seq)
+        if replayed:
+            log.info("Replayed {} journal entries".format(replayed))
+        self.journal.seq = max(self.journal.seq, game.settings.journal_seq)
+        self.game = game
+        return game
+
+    def open(self):
+        game = self.load()
+        self.checkpoint()
+        return game
+
+    def get_game(self):
+        if g.get('_write_behind_pinned'):
+            return self.game
+        if g.get('snapshot_read') and self.game is not None and \
+                not g.get('_write_behind_locked'):
+            if self.game.pin_snapshot() is not None:
+                g._write_behind_pinned = True
+                return self.game
+        if not g.get('_write_behind_locked'):
+            self.lock.acquire()
+            g._write_behind_locked = True
+        if self.game is None:
+            # opened on first use so importing the app doesn't lock the storage
+            self.open()
+            self.start()
+        # volatile so it is set on every use in case the game was ghosted
+        self.game._v_journal = self.journal
+        return self.game
+
+    def teardown(self, exception):
+        if g.get('_write_behind_pinned'):
+            # the read changed nothing, there is nothing to commit
+            g._write_behind_pinned = False
+            self.game.unpin_snapshot()
+            return
+        if not g.get('_write_behind_locked'):
+            return
+        g._write_behind_locked = False
+        try:
+            # nothing has joined the request transaction, committing it
+            # runs the after commit hooks (snapshot, tick profile)
+            if exception is None:
+                transaction.commit()
+            else:
+                transaction.abort()
+        finally:
+            self.lock.release()
+
+    def checkpoint(self):
+        with self.lock:
+            self.transaction_manager.commit()
+            self.journal.truncate(self.game.settings.journal_seq)
+            # the commit may have ghosted the game, losing _v_journal
+            self.game._v_journal = self.journal
+            self.checkpoints += 1
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.checkpoint()
+            except Exception:
+                log.exception("Checkpoint failed")
+
+    def start(self):
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name='checkpoint')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def init_app(self, app):
+        app.extensions['write_behind'] = self
+        app.teardown_request(self.teardown)
+
+    def close(self):
+        self.stop()
+        self.checkpoint()
+        self.connection.close()
+        self.journal.close()
@@ -0,0 +1,80 @@
+import logging.config
+import math
+import threading
+from collections import deque
+from time import time
+
+import transaction
+
+from settings import TICK_PROFILE_SIZE
+
+log = logging.getLogger(__name__)
+
+PHASES = ('leak', 'fund_network', 'propagate', 'snapshot', 'commit', 'total')
+
+
+def percentile(values, p):
+    """ Nearest-rank percentile of an already sorted list """
+    if not values:
+        return None
+    k = int(math.ceil(p / 100.0 * len(values))) - 1
+    return values[max(0, k)]
+
+
+class TickProfiler(object):
+    """ Ring buffer of the timings and sizes of the most recent ticks
+
+    A profile is a dict of phase -> seconds (see PHASES) plus the node,
+    edge and wallet entry counts and the number of ticks run. It is
+    recorded once the tick's transaction has committed so the commit
+    time is included, a tick that is aborted is not recorded.
+    """
+
+    def __init__(self, size=TICK_PROFILE_SIZE):
+        self.profiles = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def record(self, profile):
+        with self._lock:
+            self.profiles.append(profile)
+
+    def record_on_commit(self, profile):
+        started = []
+
+        def before():
+            started.append(time())
+
+        def after(succeeded):
+            if not succeeded:
+                return
+            commit = time() - started[0]
+            profile['commit'] = commit
+            profile['total'] += commit
+            self.record(profile)
+
+        txn = transaction.get()
+        txn.addBeforeCommitHook(before)
+        txn.addAfterCommitHook(after)
+
+    def recent(self):
+        with self._lock:
+            return list(self.profiles)
+
+    def summary(self):
+        profiles = self.recent()
+        res = {}
+        for phase in PHASES:
+            values = sorted(p[phase] for p in profiles if phase in p)
+            res[phase] = dict(count=len(values),
+                              p50=percentile(values, 50),
+                              p95=percentile(values, 95),
+                              p99=percentile(values, 99),
+                              max=values[-1] if values else None)
+        return res
+
+    def clear(self):
+        with self._lock:
+            self.profiles.clear()
+
+
+tick_profiler = TickProfiler()
@@ -0,0 +1,66 @@
+""" Rebuild the game from its last checkpoint and the journal
+
+Loads the game from the storage, replays the journal entries newer than
+the checkpoint and reports how long it took. With --checkpoint the
+result is committed and the journal truncated, as the server does when
+it starts with PERSISTENCE = 'write_behind'. Stop the server first, the
+storage can only be opened by one process.
+
+    PYTHONPATH=.:gameserver python gameserver/replay.py --storage file://app.fs --journal app.journal
+"""
+import argparse
+from time import time
+
+import zodburi
+from ZODB.DB import DB
+
+import settings
+from persistence import Journal, WriteBehindStore
+
+
+def open_db(uri):
+    factory, dbargs = zodburi.resolve_uri(uri)
+    return DB(factory(), **dbargs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--storage', default='file://app.fs', help='ZODB storage URI')
+    parser.add_argument('--journal', default=settings.JOURNAL_PATH)
+    parser.add_argument('--list', action='store_true',
+                        help='only print the journal entries')
+    parser.add_argument('--checkpoint', action='store_true',
+                        help='commit the replayed game and truncate the journal')
+    args = parser.parse_args()
+
+    journal = Journal(args.journal)
+    if args.list:
+        for seq, op, data in journal.entries():
+            print seq, op, data
+        return
+
+    db = open_db(args.storage)
+    store = WriteBehindStore(db, journal)
+    ops = {}
+    for seq, op, data in journal.entries():
+        ops[op] = ops.get(op, 0) + 1
+
+    t0 = time()
+    game = store.load()
+    elapsed = time() - t0
+    print "replayed up to entry {} in {:.2f}s, at tick {}".format(
+        game.settings.journal_seq, elapsed, game.settings.tick_seq)
+    for op, count in sorted(ops.items()):
+        print "  {:28} {:8d}".format(op, count)
+
+    if args.checkpoint:
+        store.checkpoint()
+        print "checkpointed"
+    store.connection.close()
+    db.close()
+    journal.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,171 @@
+import logging.config
+import threading
+from time import time
+
+from ZODB.POSException import ConflictError
+
+from settings import TICKINTERVAL, MAX_CATCHUP_TICKS, TICK_COALESCE_WINDOW
+from database import commit_with_retries
+from game import get_game
+
+log = logging.getLogger(__name__)
+
+
+class TickScheduler(object):
+    """ Runs Game.tick every TICKINTERVAL seconds while the game is running
+
+    Ticks are due at fixed times (start + k * interval) so time spent
+    ticking or a late wake up does not push later ticks back. Ticks that
+    were missed are run together as one Game.tick(n) batch and one
+    commit, at most max_catchup of them, the rest are dropped. A batch
+    that still conflicts after commit_with_retries has retried it is
+    dropped too.
+    """
+
+    def __init__(self, app, interval=TICKINTERVAL, max_catchup=MAX_CATCHUP_TICKS, clock=time):
+        self.app = app
+        self.interval = interval
+        self.max_catchup = max_catchup
+        self.clock = clock
+        self.next_tick = None
+        self.ticks = 0      # ticks run
+        self.coalesced = 0  # ticks run late as part of a catch-up batch
+        self.dropped = 0    # missed ticks beyond max_catchup or lost to conflicts
+        self.overruns = 0   # batches that took longer than the interval
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def due(self, now):
+        if self.next_tick is None:
+            self.next_tick = now + self.interval
+        if now < self.next_tick:
+            return 0
+        return int((now - self.next_tick) // self.interval) + 1
+
+    def run_pending(self):
+        now = self.clock()
+        due = self.due(now)
+        if not due:
+            return 0
+        self.next_tick += due * self.interval
+        if due > self.max_catchup:
+            self._drop(due - self.max_catchup)
+            due = self.max_catchup
+
+        ran = self._tick(due)
+        if ran:
+            self.ticks += ran
+            self.coalesced += ran - 1
+        if self.clock() - now > self.interval:
+            self.overruns += 1
+        return ran
+
+    def _drop(self, ticks):
+        self.dropped += ticks
+        metrics = self.app.extensions.get('metrics')
+        if metrics is not None:
+            metrics.count_dropped_ticks(ticks)
+
+    def _tick(self, ticks):
+        def tick():
+            game = get_game()
+            if not game.is_running():
+                return 0
+            game.tick(ticks)
+            game.publish_tick()
+            return ticks
+
+        # the request context gives us a ZODB connection, committed here
+        # rather than when the context is popped so conflicts are retried
+        with self.app.test_request_context():
+            try:
+                return commit_with_retries(tick)
+            except ConflictError:
+                log.warning("Dropped {} scheduled ticks after conflicts".format(ticks))
+                self._drop(ticks)
+                return 0
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                self.run_pending()
+            except Exception:
+                log.exception("Scheduled tick failed")
+            self._stopped.wait(max(0.0, self.next_tick - self.clock()))
+
+    def start(self):
+        self.next_tick = self.clock() + self.interval
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name='tick-scheduler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def stats(self):
+        return dict(interval=self.interval,
+                    ticks=self.ticks,
+                    coalesced=self.coalesced,
+                    dropped=self.dropped,
+                    overruns=self.overruns)
+
+
+class _Flight(object):
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class TickCoalescer(object):
+    """ Single-flight execution of tick requests
+
+    Calls to run with the same key while one is executing wait for it and
+    get its result instead of running again, as do calls within window
+    seconds of it finishing. run returns (result, leader) where leader is
+    True only for the call that actually executed.
+    """
+
+    def __init__(self, window=TICK_COALESCE_WINDOW, clock=time):
+        self.window = window
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._flights = {}
+        self._finished = {}
+
+    def run(self, key, f):
+        with self._lock:
+            finished = self._finished.get(key)
+            if finished is not None and self.clock() - finished[0] <= self.window:
+                return finished[1], False
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result, False
+
+        try:
+            flight.result = f()
+        except Exception, e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+                if flight.error is None:
+                    self._finished[key] = (self.clock(), flight.result)
+            flight.done.set()
+        return flight.result, True
+
+
+tick_coalescer = TickCoalescer()
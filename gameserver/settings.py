@@ -11,3 +11,28 @@ APP_VERSION = "2.0"
 #GAME_ID = "Global Festival of Ideas for Sustainable Development"
 
 TICKINTERVAL = 3
+
+# run ticks in process every TICKINTERVAL seconds (see scheduler.py)
+# instead of waiting for PUT /game/tick, and how many missed ticks it
+# will catch up on in one go
+TICK_SCHEDULER = False
+MAX_CATCHUP_TICKS = 100
+
+# PUT /game/tick calls for the same number of ticks arriving while one
+# is running, or within this many seconds of it finishing, share its result
+TICK_COALESCE_WINDOW = 1.0
+
+# how many of the most recent ticks GET /game/tick_profile summarises
+TICK_PROFILE_SIZE = 500
+
+# 'zodb' commits every request to ZODB, 'write_behind' keeps the game in
+# memory, journals changes to JOURNAL_PATH and commits to ZODB every
+# CHECKPOINT_INTERVAL seconds (see persistence.py)
+PERSISTENCE = 'zodb'
+CHECKPOINT_INTERVAL = 60
+JOURNAL_PATH = 'app.journal'
+
+# how many times a request that hits a ZODB ConflictError is run again,
+# sleeping up to CONFLICT_BACKOFF * 2**attempt seconds before each retry
+CONFLICT_RETRIES = 3
+CONFLICT_BACKOFF = 0.05
@@ -0,0 +1,103 @@
+import logging.config
+import threading
+from time import time
+
+import transaction
+
+from utils import node_to_dict, node_to_dict2
+
+log = logging.getLogger(__name__)
+
+
+def league_rows(game):
+    res = []
+    for t in game.top_players():
+        if not t.goal_id:
+            continue
+
+        goal = game.get_goal(t.goal_id)
+        r = {'id': t.id,
+             'name': t.name,
+             'goal': goal.name,
+             'goal_contribution': "{:.2f}".format(game.goal_funded_by_player(t.id)),
+             'goal_total': "{:.2f}".format(goal.balance),
+             }
+        res.append(r)
+    return res
+
+
+class Snapshot(object):
+    """ Read-only copy of what the read endpoints show, taken after a tick
+
+    The rendered dicts are shared between requests so callers must copy
+    anything they want to change. nodes only holds goals and policies,
+    players change between ticks and are rendered when they are read.
+    """
+
+    def __init__(self, game):
+        d = self.__dict__
+        d['game_id'] = game.id
+        d['tick_seq'] = game.settings.tick_seq
+        d['network_seq'] = game.settings.network_seq
+        d['network_version'] = game.network.version
+        d['taken'] = time()
+        d['goals'] = tuple(node_to_dict(g) for g in game.get_goals())
+        d['policies'] = tuple(node_to_dict(p) for p in game.get_policies())
+        d['nodes'] = { n.id: node_to_dict2(n) for n in game.network.ranked_nodes }
+        d['league'] = tuple(league_rows(game))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Snapshot is immutable")
+
+
+class Published(object):
+    """ Holds the snapshot of the last committed tick
+
+    Publishing swaps a single reference so readers see either the old or
+    the new snapshot, never a mix of the two. A snapshot is only handed
+    out while the game is at the tick, network seq and network version it
+    was taken at, so once another worker commits a tick, replaces or
+    changes the network or adds players the reads fall back to the live
+    game until this process ticks again.
+
+    A thread can pin the current snapshot, its gets then return that one
+    without looking at the game, which may be half way through a tick.
+    """
+
+    def __init__(self):
+        self.snapshot = None
+        self._pinned = threading.local()
+
+    def get(self, game):
+        pinned = getattr(self._pinned, 'snapshot', None)
+        if pinned is not None:
+            return pinned
+        snapshot = self.snapshot
+        if snapshot is not None and snapshot.game_id == game.id and \
+                snapshot.tick_seq == game.settings.tick_seq and \
+                snapshot.network_seq == game.settings.network_seq and \
+                snapshot.network_version == game.network.version:
+            return snapshot
+        return None
+
+    def publish(self, snapshot):
+        self.snapshot = snapshot
+
+    def publish_on_commit(self, snapshot):
+        def hook(succeeded):
+            if succeeded:
+                self.publish(snapshot)
+        transaction.get().addAfterCommitHook(hook)
+
+    def invalidate(self):
+        self.snapshot = None
+
+    def pin(self):
+        snapshot = self._pinned.snapshot = self.snapshot
+        return snapshot
+
+    def unpin(self):
+        self._pinned.snapshot = None
+
+
+published = Published()
@@ -1,13 +1,33 @@
 from struct import pack, unpack, unpack_from, calcsize
+import pickle
 import unittest
 from uuid import uuid4, UUID
 from types import IntType, FloatType
 
+def player_key(player_id):
+    """ Normalise a UUID object or UUID string to the 16 byte wallet key """
+    if isinstance(player_id, UUID):
+        return player_id.bytes
+    elif len(player_id) == 36 and player_id[8] == '-':
+        # the same as UUID(player_id).bytes without parsing into an int
+        return player_id.replace('-', '').decode('hex')
+    return player_id
+
+
 class Wallet:
 
     HDR_FMT = "f"
     MSG_FMT = "16sf"
 
+    # entries are stored unscaled and multiplied by _scale when read, so
+    # proportional leaks and withdrawals only have to touch the scale.
+    # Once the scale drifts below SCALE_PRECISION it is folded back in.
+    SCALE_PRECISION = 1e-6
+    # amounts that have decayed below DUST are dropped when the scale is
+    # folded in, which also happens before a wallet is pickled
+    DUST = 0.001
+    _scale = 1.0
+
     def __init__(self, items=None):
         self._total = 0.0
         self._entries = {}
@@ -16,8 +36,34 @@ class Wallet:
             for player, amount in items:
                 self.add(player, amount)
 
-        
+    @classmethod
+    def from_entries(cls, entries):
+        """ Build a wallet from (16 byte player key, amount > 0) pairs """
+        wallet = cls()
+        wallet._entries = dict(entries)
+        wallet._total = sum(wallet._entries.values())
+        return wallet
+
+    def _normalise(self):
+        scale = self._scale
+        if scale != 1.0:
+            dust = self.DUST
+            self._entries = { k:v*scale for (k,v) in self._entries.items() if v*scale > dust }
+            self._scale = 1.0
+            self._total = sum(self._entries.values(), 0.0)
+
+    def __getstate__(self):
+        self._normalise()
+        return self.__dict__
+
+    def _rescale(self, factor):
+        self._scale *= factor
+        self._total *= factor
+        if self._scale < self.SCALE_PRECISION:
+            self._normalise()
+
     def _add(self, player_id, amount):
+        self._normalise()
         self._total -= self._entries.get(player_id, 0)
         if amount > 0:
             self._entries[player_id] = amount
@@ -30,11 +76,33 @@ class Wallet:
 
 
     def add(self, player_id, amount):
-        if isinstance(player_id, UUID):
-            player_id = player_id.bytes
-        elif len(player_id) == 36 and player_id[8] == '-':
-            player_id = UUID(player_id).bytes
-        self._add(player_id, amount)
+        self._add(player_key(player_id), amount)
+
+    def credit(self, player_id, amount):
+        """ Add amount to whatever player_id already holds, in place """
+        if amount <= 0:
+            return
+        key = player_key(player_id)
+        _e = self._entries
+        _e[key] = _e.get(key, 0.0) + amount / self._scale
+        self._total += amount
+
+    def merge(self, other):
+        """ In-place version of `self & other` """
+        return self.merge_all((other,))
+
+    def merge_all(self, wallets):
+        """ Fold every wallet in wallets into this one in a single pass """
+        _e = self._entries
+        eget = _e.get
+        for other in wallets:
+            if not isinstance(other, type(self)):
+                raise ValueError
+            factor = other._scale / self._scale
+            for p,v in other._entries.items():
+                _e[p] = eget(p, 0.0) + v * factor
+            self._total += other._total
+        return self
 
     @property
     def total(self):
@@ -49,12 +117,13 @@ class Wallet:
     def dumps(self):
         fmt = self.MSG_FMT
         return pack(self.HDR_FMT, self._total) + \
-            ''.join([pack(fmt, k,v) for (k,v) in self._entries.items()])
+            ''.join([pack(fmt, k,v) for (k,v) in self.items()])
 
     def loads(self, data):
         hdr_len = calcsize(self.HDR_FMT)
         hdr,data = data[:hdr_len], data[hdr_len:]
         self._total = unpack(self.HDR_FMT, hdr)[0]
+        self._scale = 1.0
         msg_len = calcsize(self.MSG_FMT)
         fmt = self.MSG_FMT
         for i in range(0, len(data), msg_len):
@@ -62,15 +131,13 @@ class Wallet:
             self._entries[k] = v
 
     def __getitem__(self, index):
-        return self._entries[index]
+        return self._entries[index] * self._scale
 
     def get(self, player_id, default=None):
-        if isinstance(player_id, UUID):
-            player_id = player_id.bytes
-        elif len(player_id) == 36 and player_id[8] == '-':
-            player_id = UUID(player_id).bytes
-
-        return self._entries.get(player_id, default)
+        amount = self._entries.get(player_key(player_id))
+        if amount is None:
+            return default
+        return amount * self._scale
 
     def __eq__(self, other):
         if not isinstance(other, type(self)):
@@ -85,7 +152,7 @@ class Wallet:
         return not self.__eq__(other)
 
     def todict(self):
-        return { str(UUID(bytes=k)): v for (k,v) in self._entries.items() }
+        return { str(UUID(bytes=k)): v for (k,v) in self.items() }
 
     def transfer(self, dest, amount):
         if amount > self.total:
@@ -95,53 +162,35 @@ class Wallet:
             return
 
         ratio = amount / self.total
-        amounts = {}
 
-        # go through source wallet and work out how much to transfer
-        # from each player as a ratio of the total amount
-        # store that in amounts so we can add it later
-        # construct a new source wallet with amounts deducted
-        _e = self._entries
-        for player in _e:
-            amount =  _e[player] * ratio
-            amounts[player] = amount
-            _e[player] -= amount
-
-        self._entries = { k:v for (k,v) in self._entries.items() if v > 0.001 }
-        self._total = sum([x for x in self._entries.values()])
-        
-        # Go through a combined list of players in amounts and dest
-        # entries and add them up in new dict, keeping running total
+        # each player moves the same share of their amount, so credit
+        # dest with the scaled entries and just shrink our own scale
+        factor = self._scale * ratio / dest._scale
         _de = dest._entries
-        _a = amounts
-        _ne = {}
-        _nt = 0.0
-        for p,v in _a.items() + _de.items():
-            t = _ne.get(p, 0.0) + v
-            _nt += v
-            _ne[p] = t
-        
-        # assign new values to dest
-        dest._total = _nt
-        dest._entries = _ne
+        dget = _de.get
+        for p,v in self._entries.iteritems():
+            _de[p] = dget(p, 0.0) + v * factor
+        dest._total += amount
+
+        self._rescale(1.0 - ratio)
 
     def leak(self, factor):
-        _e = self._entries
-        for p in _e:
-            t = _e[p] * factor
-            _e[p] -= t
-            self._total -= t
+        self._rescale(1.0 - factor)
 
+    def _scaled_copy(self, factor):
+        new_wallet = self.__class__()
+        if factor > 0:
+            new_wallet._entries = self._entries.copy()
+            new_wallet._scale = self._scale
+            new_wallet._total = self._total
+            new_wallet._rescale(factor)
+        return new_wallet
 
     def __mul__(self, other):
         if type(other) not in [IntType, FloatType]:
             raise ValueError
 
-        new_wallet = self.__class__()
-        for player,amount in self._entries.iteritems():
-            new_wallet._add(player, amount * other)
-
-        return new_wallet
+        return self._scaled_copy(other)
 
     def __add__(self, other):
         if type(other) not in [IntType, FloatType]:
@@ -150,11 +199,7 @@ class Wallet:
         total = self._total
         new_total = self._total + other
         factor = new_total / total
-        new_wallet = self.__class__()
-        for player,amount in self._entries.iteritems():
-            new_wallet._add(player, amount * factor)
-
-        return new_wallet
+        return self._scaled_copy(factor)
 
     def __sub__(self, other):
         return self.__add__(-other)
@@ -165,19 +210,39 @@ class Wallet:
 
         a = self._entries
         b = other._entries
+        sa = self._scale
+        sb = other._scale
         new_wallet = self.__class__()
 
         nwa = new_wallet._add
         aget = a.get
         bget = b.get
         for key in set(a) | set(b):
-            nwa(key, aget(key, 0.0) + bget(key, 0.0))
+            nwa(key, aget(key, 0.0) * sa + bget(key, 0.0) * sb)
 
         return new_wallet
 
     def items(self):
+        self._normalise()
         return self._entries.items()
 
+
+def merge_changes(old, committed, new):
+    """ committed with the change from old to new applied to each player
+
+    Used to resolve concurrent writes to the same wallet. Any of the
+    wallets can be None for empty and players that end up with nothing
+    are dropped.
+    """
+    o = dict(old.items()) if old is not None else {}
+    c = dict(committed.items()) if committed is not None else {}
+    n = dict(new.items()) if new is not None else {}
+    res = Wallet()
+    for key in set(o) | set(c) | set(n):
+        res._add(key, c.get(key, 0.0) + n.get(key, 0.0) - o.get(key, 0.0))
+    return res
+
+
 class WalletTests(unittest.TestCase): # pragma: no cover
 
     def testEmptyWallet(self):
@@ -615,5 +680,133 @@ class WalletTests(unittest.TestCase): # pragma: no cover
 
         self.assertEqual(w1.items(), [(player1_id.bytes, 10.0)])
 
+    def testLeakIsLazy(self):
+        u1 = uuid4()
+        w1 = Wallet([(u1, 100.0)])
+        w1.leak(0.5)
+        w1.leak(0.5)
+
+        self.assertEqual(w1._entries[u1.bytes], 100.0)
+        self.assertEqual(w1[u1.bytes], 25.0)
+        self.assertEqual(w1.get(u1), 25.0)
+        self.assertEqual(w1.total, 25.0)
+
+        self.assertEqual(w1.todict(), {str(u1): 25.0})
+        self.assertEqual(w1._scale, 1.0)
+
+    def testScaleNormalisedPastPrecision(self):
+        w1 = Wallet([(uuid4(), 1e12), (uuid4(), 5e11)])
+        for i in range(10):
+            w1.leak(0.9)
+
+        self.assertTrue(w1._scale >= Wallet.SCALE_PRECISION)
+        self.assertTrue(max(w1._entries.values()) < 1e6)
+        self.assertEqual(len(w1), 2)
+        self.assertAlmostEqual(w1.total / (1.5e12 * 0.1**10), 1.0)
+
+    def testTransferFromAndToScaledWallets(self):
+        u1 = uuid4()
+        u2 = uuid4()
+        w1 = Wallet([(u1, 10.0), (u2, 30.0)])
+        w2 = Wallet([(u1, 20.0)])
+        w1.leak(0.5)
+        w2.leak(0.5)
+
+        w1.transfer(w2, 10.0)
+
+        self.assertAlmostEqual(w1.get(u1), 2.5)
+        self.assertAlmostEqual(w1.get(u2), 7.5)
+        self.assertAlmostEqual(w1.total, 10.0)
+        self.assertAlmostEqual(w2.get(u1), 12.5)
+        self.assertAlmostEqual(w2.get(u2), 7.5)
+        self.assertAlmostEqual(w2.total, 20.0)
+
+    def testCredit(self):
+        u1 = uuid4()
+        w1 = Wallet([(u1, 10.0)])
+        w1.leak(0.5)
+        w1.credit(u1, 5.0)
+        w1.credit(str(u1), 2.5)
+        w1.credit(u1, -1.0)
+
+        self.assertAlmostEqual(w1.get(u1), 12.5)
+        self.assertAlmostEqual(w1.total, 12.5)
+        self.assertEqual(len(w1), 1)
+
+    def testMergeInPlace(self):
+        u1 = str(uuid4())
+        u2 = str(uuid4())
+        u3 = str(uuid4())
+        w1 = Wallet([(u1, 100.0), (u2, 200.0)])
+        w2 = Wallet([(u2, 100.0), (u3, 50.0)])
+        before = w1
+
+        w1.merge(w2)
+
+        self.assertIs(w1, before)
+        self.assertEqual(w1, Wallet([(u1, 100.0), (u2, 300.0), (u3, 50.0)]))
+        self.assertEqual(w2, Wallet([(u2, 100.0), (u3, 50.0)]))
+
+    def testMergeAll(self):
+        u1 = str(uuid4())
+        u2 = str(uuid4())
+        w1 = Wallet([(u1, 10.0)])
+        w2 = Wallet([(u1, 20.0), (u2, 40.0)])
+        w3 = Wallet([(u2, 8.0)])
+        w2.leak(0.5)
+
+        w1.merge_all([w2, w3])
+
+        self.assertAlmostEqual(w1.get(u1), 20.0)
+        self.assertAlmostEqual(w1.get(u2), 28.0)
+        self.assertAlmostEqual(w1.total, 48.0)
+
+    def testMergeBadType(self):
+        w1 = Wallet([(str(uuid4()), 10.0)])
+        with self.assertRaises(ValueError):
+            w1.merge(1.0)
+
+    def testAddToScaledWallet(self):
+        u1 = uuid4()
+        u2 = uuid4()
+        w1 = Wallet([(u1, 10.0), (u2, 30.0)])
+        w1.leak(0.5)
+        w1.add(u1, 20.0)
+
+        self.assertEqual(w1.get(u1), 20.0)
+        self.assertEqual(w1.get(u2), 15.0)
+        self.assertEqual(w1.total, 35.0)
+
+    def testDecayedEntriesDropped(self):
+        u1 = uuid4()
+        u2 = uuid4()
+        w1 = Wallet([(u1, 10.0), (u2, 1000.0)])
+        for i in range(200):
+            w1.leak(0.1)
+
+        self.assertEqual(w1.todict(), {})
+        self.assertEqual(w1.total, 0.0)
+
+        w2 = Wallet([(u1, 1.0), (u2, 1000.0)])
+        w2.leak(0.9995)
+        state = pickle.loads(pickle.dumps(w2)).__dict__
+        self.assertEqual(state['_entries'].keys(), [u2.bytes])
+        self.assertAlmostEqual(state['_total'], 0.5)
+
+    def testMergeChanges(self):
+        u1 = str(uuid4())
+        u2 = str(uuid4())
+        u3 = str(uuid4())
+        old = Wallet([(u1, 10.0), (u2, 10.0)])
+        # one writer leaked everything by half, the other moved u2 out and u3 in
+        committed = old * 0.5
+        new = Wallet([(u1, 10.0), (u3, 5.0)])
+
+        merged = merge_changes(old, committed, new)
+        self.assertEqual(merged.todict(), {u1: 5.0, u3: 5.0})
+        self.assertEqual(merged.total, 10.0)
+        self.assertEqual(merge_changes(None, None, new).todict(), new.todict())
+
+
 if __name__ == '__main__': # pragma: no cover               
     unittest.main()